@@ -26,6 +26,8 @@ usage="""
     sourmash scripts prefetch_tables  prefetch-dir/*.prefetch.csv --output prefetch.csv
     sourmash scripts hash_tables 
         - Allows downsampling
+    sourmash scripts ranktable_index ranktable.csv --scaled 10000 -o ranktable.idx
+        - Reused by hash_tables in place of ranktable.csv
 """
 
 epilog="""
@@ -37,25 +39,38 @@ Need help? Have questions? Ask at http://github.com/sourmash-bio/sourmash/issues
 import argparse
 import sourmash
 
-from sourmash.index import LinearIndex
 from sourmash.logging import debug_literal
+from sourmash.picklist import SignaturePicklist
 from sourmash.plugins import CommandLinePlugin
 
 from sourmash.save_load import (Base_SaveSignaturesToLocation,
                                 _get_signatures_from_rust)
 import sourmash_utils
 #from sourmash_args import load_file_as_index
-from sourmash.index import LinearIndex
 
 import sys
 import os
+import numpy as np
 import polars as pl
+import scipy.sparse
 import argparse
-from concurrent.futures import ThreadPoolExecutor
+import collections
+import csv
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
 import gzip
+import hashlib
 import io
+import json
+import platform
+import resource
+import subprocess
+import threading
+import time
 
-sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+# reconfigure in place; rewrapping sys.stdout.buffer closes the stream when the old wrapper is collected
+if hasattr(sys.stdout, 'reconfigure'):
+    sys.stdout.reconfigure(encoding='utf-8')
 
 class Command_Prefetch_Tables(CommandLinePlugin):
     command = 'prefetch_tables'             # 'scripts <command>'
@@ -70,15 +85,27 @@ class Command_Prefetch_Tables(CommandLinePlugin):
         # Subparser for 'prefetch'
         parser_prefetch.add_argument('filenames', nargs='+', help="List of input sourmash prefetch files to combine.")
         parser_prefetch.add_argument('-t', '--taxonomy-file', '--taxonomy', nargs='?', metavar='FILE', default=None, help="The Sourmash taxonomy file that corresponds with the database that generated the sourmash prefetch files.")
-        parser_prefetch.add_argument('-l', '--lineage-rank', '--lineage', default='species', help="Compress the tables by user-defined taxonomic lineage rank associated with sourmash taxonomic file")
+        parser_prefetch.add_argument('-l', '--lineage-rank', '--lineage', default='species', help="Compress the tables by user-defined taxonomic lineage rank associated with sourmash taxonomic file.\nSeveral comma-separated ranks (e.g. 'genus,family,phylum') are built from one pass over the inputs and written to '<output>.<rank>.csv'.")
+        parser_prefetch.add_argument('--all-ranks', action='store_true', help="Build a table for every lineage rank found in the taxonomy file (Requires '-t').")
         parser_prefetch.add_argument('-c', '--column', type=str, default='intersect_bp', help="The numerical column from 'prefetch' to populate the table values (Suggestion: 'jaccard').\nVisit https://sourmash.readthedocs.io/en/latest/classifying-signatures.html#id23 for more information.")
         parser_prefetch.add_argument('--collapse-columns', nargs="*", help='Collapse the polars dataframe by the header of each text file and sum the presence information (Requires "-p" argument)')
         parser_prefetch.add_argument('--extract-columns', nargs="*", help='Extract the columns from the polars dataframe by the values of each text file')
         parser_prefetch.add_argument('-p', '--presence', action='store_true', help="For whatever value selected by `--column` convert to a binary opposition. I.e. Presence or Abseence, 1 or 0")
         parser_prefetch.add_argument('--filter', type=numeric_type, default=1000, help="For whatever value selected by `--column` ignore any value below this filter cutoff. 'intersect_bp' <= 1000 will be ignored as default.")
         parser_prefetch.add_argument('-o', '--output', required=True, help="Path to save the combined output CSV file.")
-        parser_prefetch.add_argument('-f', '--format', choices=['dense', 'sparse'], default='dense', help="Output file structure: dense or sparse OTU.")
+        parser_prefetch.add_argument('-f', '--format', choices=['dense', 'sparse', *SPARSE_MATRIX_FORMATS], default='dense', help="Output file structure: dense or sparse OTU,\nor a sparse matrix as Matrix Market ('mtx') or scipy CSR ('npz') with '<output>.rows.txt' and '<output>.cols.txt' labels.")
         parser_prefetch.add_argument('-z', '--gzip', action='store_true', help="Compress the output file into a .gz file type.")
+        parser_prefetch.add_argument('--output-format', choices=OUTPUT_FORMATS, default=None, help="Output container: csv, csv.gz, parquet or ipc (Arrow IPC); parquet and ipc use zstd compression\n(default: from the extension of '-o', else csv). '-z' is the same as '--output-format csv.gz'.")
+        parser_prefetch.add_argument('--append-to', metavar='EXISTING', default=None, help="Merge only new or changed inputs into the table EXISTING (csv, parquet or ipc), writing the result to '-o'.\nIncluded inputs are recorded in '<output>.manifest.csv'; EXISTING is built from scratch if it does not exist.")
+        parser_prefetch.add_argument('--streaming', action='store_true', help="Build the dense table with the polars streaming engine and write it in row chunks, bounding peak memory.")
+        parser_prefetch.add_argument('--chunk-size', type=int, default=10_000, help="Number of table rows per chunk with --streaming. One chunk is in memory at once for csv output,\nat most five (four being compressed) for csv.gz (default: 10000).")
+        parser_prefetch.add_argument('--cache-dir', metavar='DIR', default=None, help="Cache the parsed name and numeric columns of each input, and the taxonomy (-t), as parquet in DIR, keyed by path, size and mtime.")
+        parser_prefetch.add_argument('--cache-max-size', type=float, default=10, metavar='GB', help="Evict the least recently used cache files beyond this size (default: 10 GB).")
+        parser_prefetch.add_argument('--profile-json', metavar='FILE', default=None, help="Write the wall time, table shapes and peak memory (RSS) of each stage to FILE as JSON.")
+        parser_prefetch.add_argument('--profile-plans', action='store_true', help="With --profile-json, also record the optimized polars query plan of each table.")
+        parser_prefetch.add_argument('--explain', action='store_true', help="Print the optimized polars query plan of each table before it is built.")
+        parser_prefetch.add_argument('--cores', type=int, default=None, help="Maximum number of threads used to probe the input files and to compress gzipped output\n(default: chosen by Python's ThreadPoolExecutor, and up to 4 threads for compression)")
+        parser_prefetch.add_argument('--report', choices=['auto', 'summary', 'full'], default='auto', help="Terminal report of the finished table: previews and viewing hints ('full'), only its shape and size ('summary'),\nor 'full' for tables of at most 1M cells and 'summary' beyond (default: auto).")
         parser_prefetch.add_argument('-v', '--verbose', action='store_true', help="Please flood my terminal with output. Thx.")
 
         debug_literal('RUNNING cmd_prefetch_tables.__init__')
@@ -86,7 +113,12 @@ class Command_Prefetch_Tables(CommandLinePlugin):
     def main(self, args):
         super().main(args)
 
-        tables_main(args)
+        profiler = StageProfiler(args.profile_json, command=self.command, plans=args.profile_plans)
+        try:
+            tables_main(args, profiler)
+            profiler.completed = True
+        finally:
+            profiler.write()
 
 
 class Command_Gather_Tables(CommandLinePlugin):
@@ -102,15 +134,27 @@ class Command_Gather_Tables(CommandLinePlugin):
         # Subparser for 'gather'
         parser_gather.add_argument('filenames', nargs='+', help="List of input sourmash gather files to combine.")
         parser_gather.add_argument('-t', '--taxonomy-file', '--taxonomy', nargs='?', metavar='FILE', default=None, help="The Sourmash taxonomy file that corresponds with the database that generated the sourmash gather files.")
-        parser_gather.add_argument('-l', '--lineage-rank', '--lineage', default='species', help="Compress the tables by user-defined taxonomic lineage rank associated with sourmash taxonomic file")
+        parser_gather.add_argument('-l', '--lineage-rank', '--lineage', default='species', help="Compress the tables by user-defined taxonomic lineage rank associated with sourmash taxonomic file.\nSeveral comma-separated ranks (e.g. 'genus,family,phylum') are built from one pass over the inputs and written to '<output>.<rank>.csv'.")
+        parser_gather.add_argument('--all-ranks', action='store_true', help="Build a table for every lineage rank found in the taxonomy file (Requires '-t').")
         parser_gather.add_argument('-c', '--column', type=str, default='intersect_bp', help="The numerical column from 'gather' to poplate the table values (Suggestion: 'f_unique_weighted').\nVisit https://sourmash.readthedocs.io/en/latest/classifying-signatures.html#id22 for more information.")
         parser_gather.add_argument('--collapse-columns', nargs="*", help='Collapse the polars dataframe by the header of each text file and sum the presence information (Requires "-p" argument)')
         parser_gather.add_argument('--extract-columns', nargs="*", help='Extract the columns from the polars dataframe by the values of each text file')
         parser_gather.add_argument('-p', '--presence', action='store_true', help="For whatever value selected by `--column` convert to a binary opposition. I.e. Presence or Abseence, 1 or 0")
         parser_gather.add_argument('--filter', type=numeric_type, default=1000, help="For whatever value selected by `--column` ignore any value below this filter cutoff. 'intersect_bp' <= 1000 will be ignored as default.")
         parser_gather.add_argument('-o', '--output', required=True, help="Path to save the combined output CSV file.")
-        parser_gather.add_argument('-f', '--format', choices=['dense', 'sparse'], default='dense', help="Output file structure: dense or sparse OTU.")
+        parser_gather.add_argument('-f', '--format', choices=['dense', 'sparse', *SPARSE_MATRIX_FORMATS], default='dense', help="Output file structure: dense or sparse OTU,\nor a sparse matrix as Matrix Market ('mtx') or scipy CSR ('npz') with '<output>.rows.txt' and '<output>.cols.txt' labels.")
         parser_gather.add_argument('-z', '--gzip', action='store_true', help="Compress the output file into a .gz file type.")
+        parser_gather.add_argument('--output-format', choices=OUTPUT_FORMATS, default=None, help="Output container: csv, csv.gz, parquet or ipc (Arrow IPC); parquet and ipc use zstd compression\n(default: from the extension of '-o', else csv). '-z' is the same as '--output-format csv.gz'.")
+        parser_gather.add_argument('--append-to', metavar='EXISTING', default=None, help="Merge only new or changed inputs into the table EXISTING (csv, parquet or ipc), writing the result to '-o'.\nIncluded inputs are recorded in '<output>.manifest.csv'; EXISTING is built from scratch if it does not exist.")
+        parser_gather.add_argument('--streaming', action='store_true', help="Build the dense table with the polars streaming engine and write it in row chunks, bounding peak memory.")
+        parser_gather.add_argument('--chunk-size', type=int, default=10_000, help="Number of table rows per chunk with --streaming. One chunk is in memory at once for csv output,\nat most five (four being compressed) for csv.gz (default: 10000).")
+        parser_gather.add_argument('--cache-dir', metavar='DIR', default=None, help="Cache the parsed name and numeric columns of each input, and the taxonomy (-t), as parquet in DIR, keyed by path, size and mtime.")
+        parser_gather.add_argument('--cache-max-size', type=float, default=10, metavar='GB', help="Evict the least recently used cache files beyond this size (default: 10 GB).")
+        parser_gather.add_argument('--profile-json', metavar='FILE', default=None, help="Write the wall time, table shapes and peak memory (RSS) of each stage to FILE as JSON.")
+        parser_gather.add_argument('--profile-plans', action='store_true', help="With --profile-json, also record the optimized polars query plan of each table.")
+        parser_gather.add_argument('--explain', action='store_true', help="Print the optimized polars query plan of each table before it is built.")
+        parser_gather.add_argument('--cores', type=int, default=None, help="Maximum number of threads used to probe the input files and to compress gzipped output\n(default: chosen by Python's ThreadPoolExecutor, and up to 4 threads for compression)")
+        parser_gather.add_argument('--report', choices=['auto', 'summary', 'full'], default='auto', help="Terminal report of the finished table: previews and viewing hints ('full'), only its shape and size ('summary'),\nor 'full' for tables of at most 1M cells and 'summary' beyond (default: auto).")
         parser_gather.add_argument('-v', '--verbose', action='store_true', help="Please flood my terminal with output. Thx.")
 
         debug_literal('RUNNING cmd_gather_tables.__init__')
@@ -118,7 +162,12 @@ class Command_Gather_Tables(CommandLinePlugin):
     def main(self, args):
         super().main(args)
 
-        tables_main(args)
+        profiler = StageProfiler(args.profile_json, command=self.command, plans=args.profile_plans)
+        try:
+            tables_main(args, profiler)
+            profiler.completed = True
+        finally:
+            profiler.write()
 
 class Command_Hash_Tables(CommandLinePlugin):
     command = 'hash_tables'
@@ -131,15 +180,20 @@ class Command_Hash_Tables(CommandLinePlugin):
         super().__init__(parser_hash)
 
         #Subparser for 'hash'
-        parser_hash.add_argument('ranktable', help="Input csv containing classified hashes for specified organism")
+        parser_hash.add_argument('ranktable', help="Input csv containing classified hashes for specified organism,\nor a ranktable index built by 'sourmash scripts ranktable_index'")
         parser_hash.add_argument('sketches', nargs="+", help="Input file with sketches to process")
         parser_hash.add_argument('-o', '--output', required=True, help="Output CSV/Parquet file")
         parser_hash.add_argument('--filter-samples', default=None, help="Optional file with sample names to include")
-        parser_hash.add_argument('--format', choices=['csv', 'parquet'], default='csv',
-                                 help="Output file format: 'csv' or 'parquet' (default: csv)")
+        parser_hash.add_argument('--format', choices=['csv', 'parquet', *SPARSE_MATRIX_FORMATS, 'bits'], default='csv',
+                                 help="Output file format: 'csv', 'parquet', a sparse matrix as Matrix Market ('mtx')\nor scipy CSR ('npz') with '<output>.rows.txt' and '<output>.cols.txt' labels,\nor a bit-packed presence matrix ('bits') that compare_rows reads directly from '*.bits' files (default: csv)")
         parser_hash.add_argument('--collapse-columns', nargs="*", help='Collapse the polars dataframe by the header of each text file')
+        parser_hash.add_argument('--report', choices=['auto', 'summary', 'full'], default='auto', help="Terminal report of the finished table: previews and viewing hints ('full'), only its shape and size ('summary'),\nor 'full' for tables of at most 1M cells and 'summary' beyond (default: auto).")
         parser_hash.add_argument('-v', '--verbose', action='store_true', help="Please flood my terminal with output. Thx.")
         parser_hash.add_argument('--total-count', action='store_true', help='Sum all the presence information.')
+        parser_hash.add_argument('--abundance', nargs='?', const='count', choices=['count', 'normalized'], default=None, help="Fill the table with each hash's abundance instead of 0/1 presence (requires abundance-tracking sketches);\n'--abundance normalized' divides by the summed abundance of each downsampled sketch.\n--collapse-columns and --total-count sum the abundances.")
+        parser_hash.add_argument('--incremental', action='store_true', help="Only map sketches that are new or changed since the last run and splice them into the existing output.\nThe ranktable digest, scaled, ksize, moltype and sketch md5sums are kept in '<output>.manifest.json'.")
+        parser_hash.add_argument('--profile-json', metavar='FILE', default=None, help="Write the wall time, table shapes and peak memory (RSS) of each stage to FILE as JSON.")
+        parser_hash.add_argument('--cores', type=int, default=1, help="Number of processes used to load, downsample and map the sketch files (default: 1)")
 
         sourmash_utils.add_standard_minhash_args(parser_hash)
 
@@ -148,115 +202,258 @@ class Command_Hash_Tables(CommandLinePlugin):
     def main(self, args):
         super().main(args)
 
-        print(f"Loading rabktable CSV '{args.ranktable}'...")
-        ranktable_df = pl.read_csv(args.ranktable)
-        if args.verbose: print(ranktable_df)
+        profiler = StageProfiler(args.profile_json, command=self.command)
+        try:
+            self.build_table(args, profiler)
+            profiler.completed = True
+        finally:
+            profiler.write()
+
+    def build_table(self, args, profiler):
+        # reject incompatible options before any ranktable or sketch is loaded
+        if args.incremental and (args.collapse_columns or args.total_count or args.format not in ('csv', 'parquet')):
+            raise ValueError("--incremental only updates csv or parquet presence tables, without --collapse-columns or --total-count.")
+        if args.format == 'bits' and (args.collapse_columns or args.total_count or args.abundance):
+            raise ValueError("--format bits cannot be combined with --collapse-columns, --total-count or --abundance.")
+
+        profiler.start('load_ranktable')
+        # hashvals_l stays a numpy array (memory-mapped from an index) until a frame is written
+        index_views = {}
+        if is_ranktable_index(args.ranktable):
+            print(f"Loading ranktable index '{args.ranktable}'...")
+            hashvals_l, hashval_dtype, hash_index, index_views = load_ranktable_index(args.ranktable, verbose=args.verbose)
+        else:
+            print(f"Loading rabktable CSV '{args.ranktable}'...")
+            ranktable_df = pl.read_csv(args.ranktable)
+            if args.verbose: print(ranktable_df)
+            hashval_dtype = ranktable_df['hashval'].dtype
+            hashvals_l = ranktable_df['hashval'].to_numpy()
+            hash_index = build_hashval_index(hashvals_l)
+            del ranktable_df
 
-        hashvals_l = ranktable_df['hashval']
         print(f"Loaded {len(hashvals_l)} hashvals...")
         if args.verbose: print(hashvals_l)
 
-        select_mh = sourmash_utils.create_minhash_from_args(args)
+        select_mh = sourmash_utils.create_minhash_from_args(args, track_abundance=bool(args.abundance))
         print(f"Selecting sketches: {select_mh}")
 
+        select_kw = dict(ksize=select_mh.ksize,
+                         moltype=select_mh.moltype,
+                         scaled=select_mh.scaled,
+                         abund=select_mh.track_abundance)
+
         if args.verbose: print(f"Loading sketches from file '{args.sketches}'...")
         print(f"Loading {len(args.sketches)} files...")
-        combined_idx = LinearIndex()
-        for filename in args.sketches:
-            idx = sourmash.load_file_as_index(filename)
-            idx = idx.select(ksize=select_mh.ksize,
-                             moltype=select_mh.moltype,
-                             scaled=select_mh.scaled,
-                             abund=select_mh.track_abundance)
-            if len(args.sketches) > 1:
-                for sig in idx.signatures():
-                    combined_idx.insert(sig)
-                idx = combined_idx
-        print(f"    Found {len(idx)} samples")
-
-        query_minhash = next(iter(idx.signatures())).minhash.copy_and_clear()
-        if args.scaled and args.scaled != query_minhash.scaled:
+        first_idx = sourmash.load_file_as_index(args.sketches[0]).select(**select_kw)
+        first_ss = next(iter(first_idx.signatures()), None)
+        if first_ss is None:
+            raise ValueError(f"No sketches in '{args.sketches[0]}' match {select_mh}{' with abundances' if args.abundance else ''}.")
+        sketch_scaled = first_ss.minhash.scaled
+        del first_idx, first_ss
+
+        if args.scaled and args.scaled != sketch_scaled:
             print(f'Downsampling to {args.scaled}...')
-            query_minhash = query_minhash.downsample(scaled=args.scaled)
-            hashvals_l = pl.Series('hashval', list(query_minhash.hashes.keys()))
-            print(f"Loaded {len(hashvals_l)} hashvals...")
+            hashvals_l, hash_index = downsample_ranktable(hashvals_l, hash_index, args.scaled,
+                                                          rows_path=index_views.get(args.scaled))
+            print(f"Kept {len(hashvals_l)} hashvals...")
             if args.verbose: print(hashvals_l)
+        profiler.stop(rows_out=len(hashvals_l))
 
         filter_by_name = None
         if args.filter_samples:
             filter_by_name = set([x.strip() for x in open(args.filter_samples)])
 
-        print("\nBeginning hash presence mapping across all sketches")
-        presence_df = pl.DataFrame({'hashval': hashvals_l})
-        n_skipped = 0
-
-        for n, metag_ss in enumerate(idx.signatures()):
-            metag_name = metag_ss.name
-
-            if n and n % 10 == 0:
-                print('...', n, 'of', len(idx), f'({n/len(idx) * 100:.2f}%)')
-
-            if filter_by_name and metag_name not in filter_by_name:
-                n_skipped += 1
-                continue
-
-            metag_mh = metag_ss.minhash.downsample(scaled=args.scaled)
-            metag_hashes = pl.Series(list(metag_mh.hashes))
-
-            presence_column = hashvals_l.is_in(metag_hashes).cast(pl.Int32).alias(metag_name)
-            presence_df = presence_df.with_columns(presence_column)
+        known_md5s = None
+        existing_df = None
+        if args.incremental:
+            hash_manifest = dict(ranktable_digest=hashval_digest(hashvals_l), scaled=args.scaled,
+                                 ksize=select_mh.ksize, moltype=select_mh.moltype, abundance=args.abundance)
+            previous = read_hash_manifest(hash_manifest_path(args.output))
+            if previous is not None and os.path.exists(args.output) and \
+                    all(previous.get(key) == value for key, value in hash_manifest.items()):
+                known_md5s = previous['samples']
+                existing_df = scan_table(args.output).collect()
+                print(f"Found {len(known_md5s)} already-mapped sketches in '{args.output}'.")
+            else:
+                if previous is not None:
+                    print("Ranktable or sketch selection changed since the last run; mapping every sketch.")
+                known_md5s = {}
+            sample_md5s = dict(known_md5s)
 
-        if args.filter_samples: print(f"Skipped {n_skipped} samples.")
+        profiler.start('map_sketches')
+        print("\nBeginning hash presence mapping across all sketches")
+        value_dtype = {None: None, 'count': np.int32, 'normalized': np.float64}[args.abundance]
+        presence = PresenceMatrix(len(hashvals_l), dtype=value_dtype)
+        stats = dict(selected=0, skipped=0, unchanged=0)
+        seen = set()
+
+        worker_args = dict(select_kw=select_kw, scaled=args.scaled or sketch_scaled, filter_by_name=filter_by_name,
+                           known_md5s=known_md5s, abundance=args.abundance)
+        if args.cores > 1 and len(args.sketches) > 1:
+            print(f"Using {args.cores} processes...")
+            executor = ProcessPoolExecutor(max_workers=args.cores,
+                                           initializer=_init_sketch_worker,
+                                           initargs=(hash_index,))
+            results = executor.map(partial(_map_sketch_file_worker, **worker_args), args.sketches)
+        else:
+            # stream signature by signature; counters are updated in place
+            executor = None
+            results = ((iter_sketch_rows(filename, hash_index, stats=stats, seen=seen, **worker_args), None, None)
+                       for filename in args.sketches)
+
+        n_mapped = 0
+        try:
+            for n, (hits, file_stats, file_seen) in enumerate(results):
+                for metag_name, md5sum, rows, values in hits:
+                    presence.add(metag_name, rows, values)
+                    if args.incremental: sample_md5s[metag_name] = md5sum
+                    n_mapped += 1
+                    # serially the counters are current, so report every 10 sketches, even within one zip
+                    if file_stats is None and n_mapped % 10 == 0:
+                        done = n_mapped + stats['unchanged']
+                        print('...', done, 'of', stats['selected'],
+                              f"selected sketches ({done / stats['selected'] * 100:.2f}%)")
+                if file_stats is not None:
+                    for key, value in file_stats.items():
+                        stats[key] += value
+                    seen.update(file_seen)
+                    if (n + 1) % 10 == 0:
+                        print('...', n + 1, 'of', len(args.sketches), f"files ({(n + 1)/len(args.sketches) * 100:.2f}%),",
+                              stats['selected'], 'sketches selected')
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        profiler.stop(files_in=len(args.sketches), samples_out=len(presence), entries=presence.nnz)
+
+        print(f"    Found {stats['selected'] + stats['skipped']} samples")
+        if args.filter_samples: print(f"Selected {stats['selected']} samples by name; skipped {stats['skipped']} samples.")
+        if args.incremental:
+            print(f"Mapped {len(presence)} new or changed samples, {stats['unchanged']} unchanged.")
+            # a rebuilt table would not have the samples that left the inputs
+            stale = [name for name in known_md5s if name not in seen]
+            if stale:
+                shown = stale if args.verbose else stale[:10]
+                print(f"Dropping {len(stale)} samples no longer in the inputs: {', '.join(shown)}"
+                      f"{' ...' if len(shown) < len(stale) else ''}")
+                for name in stale:
+                    del sample_md5s[name]
+                existing_df = existing_df.drop(stale, strict=False)
+
+        if args.format in SPARSE_MATRIX_FORMATS and not (args.collapse_columns or args.total_count):
+            # write the presence triplets directly, without expanding them
+            profiler.start('write')
+            rows, cols = presence.to_coo()
+            n_rows, n_cols, n_entries = write_sparse_matrix(rows, cols, presence.to_values(),
+                                                            hashval_series(hashvals_l, hashval_dtype), presence.names,
+                                                            args.output, args.format)
+            profiler.stop(rows_out=n_rows, columns_out=n_cols, entries=n_entries)
+            print(f"Wrote a {n_rows} x {n_cols} sparse matrix with {n_entries} entries to {args.output}")
+            print(f"Row and column labels are in {' and '.join(sparse_label_paths(args.output))}")
+            return
+
+        if args.format == 'bits':
+            profiler.start('write')
+            write_presence_bits(args.output, hashval_series(hashvals_l, hashval_dtype), presence.names, presence.to_bits())
+            profiler.stop(rows_out=len(hashvals_l), columns_out=len(presence))
+            print(f"Wrote {len(presence)} bit-packed presence columns to {args.output}")
+            return
 
         if args.collapse_columns:
+            # accumulated sample by sample from the packed presence; the dense frame is never built
             print(f"Processing the following files: {args.collapse_columns}")
-            collapse_df = pl.DataFrame({"hashval": hashvals_l})
-
-            for fp in args.collapse_columns:
-                print(f"Processing: {fp}")
-                h, i = read_file_and_separate(fp)
-                if args.verbose: print(f"First line: {h}")
-                if args.verbose: print(f"Remaining lines: {i}")
-
-                existing_columns = [col for col in i if col in presence_df.columns]
-                if args.verbose: print(exsting_columns)
-
-                if existing_columns:
-                    new_column = (
-                            presence_df.select(
-                                sum(pl.col(col) for col in existing_columns).alias(f"{h}")
-                                ).to_series()
-                            )
-                    collapse_df = collapse_df.with_columns(new_column)
-                    print(f"... Updating DataFrame with {h}")
-                    if args.verbose: print(collapse_df)
-                else:
-                    print(f"No matching columns found for {fp}, skipping...")
-
-            if args.verbose: print("Final collapsed DataFrame:\n", collapse_df)
-            final_df = collapse_df
-        else:
-            final_df = presence_df
+            profiler.start('collapse')
+            group_names, indicator = group_indicator(presence.names, read_column_groups(args.collapse_columns),
+                                                     verbose=args.verbose)
+            group_sums = presence.group_sums(indicator)
+            final_df = pl.DataFrame([hashval_series(hashvals_l, hashval_dtype)] + [pl.Series(name, group_sums[:, j])
+                                                    for j, name in enumerate(group_names)])
+            profiler.stop(columns_in=len(presence), rows_out=final_df.height, columns_out=final_df.width)
+            if args.verbose: print("Final collapsed DataFrame:\n", final_df)
+        elif not args.total_count:
+            profiler.start('build_frame')
+            final_df = presence.to_frame(hashval_series(hashvals_l, hashval_dtype))
+            if existing_df is not None:
+                # replace changed columns in place, append new ones
+                final_df = existing_df.with_columns(final_df.drop('hashval'))
+            profiler.stop(rows_out=final_df.height, columns_out=final_df.width)
 
         if args.total_count:
-            sum_df = final_df.select([
-                pl.col(col).sum().alias(col) for col in final_df.columns if col != "hashval"
-            ])
+            profiler.start('total_count')
+            if args.collapse_columns:
+                sum_df = final_df.select([
+                    pl.col(col).sum().alias(col) for col in final_df.columns if col != "hashval"
+                ])
+            elif args.abundance:
+                sample_sums = presence.to_sparse().sum(axis=1)
+                sum_df = pl.DataFrame([pl.Series(name, [value]) for name, value in zip(presence.names, sample_sums)])
+            else:
+                # presence totals are popcounts of the packed samples and hit counts of the others
+                sample_counts = presence.counts()
+                sum_df = pl.DataFrame([pl.Series(name, [count], dtype=pl.Int32)
+                                       for name, count in zip(presence.names, sample_counts)])
             sum_df = pl.concat([pl.DataFrame({'hashval': ['count']}), sum_df], how='horizontal')
+            total_dtype = pl.Float64 if args.abundance == 'normalized' else pl.Int64
             sum_df = sum_df.with_columns(
-                pl.sum_horizontal((pl.col(pl.Int32)).cast(pl.Int64)).alias("count")
+                pl.sum_horizontal(pl.exclude('hashval').cast(total_dtype)).alias("count")
             )
             final_df = sum_df
+            profiler.stop(columns_out=final_df.width)
             if args.verbose: print(sum_df)
 
-        print(final_df)
-        if args.format == 'csv':
-            final_df.write_csv(args.output)
-        elif args.format == 'parquet':
-            final_df.write_parquet(args.output)
+        full = full_report(args, final_df)
+        if full: print(final_df)
+        stats = None if full else TableStats('hashval')
+        profiler.start('write')
+        if args.format in ('csv', 'parquet'):
+            if stats is not None: stats.update(final_df)
+            if args.format == 'csv':
+                final_df.write_csv(args.output)
+            else:
+                final_df.write_parquet(args.output)
+        elif args.format in SPARSE_MATRIX_FORMATS:
+            matrix = final_df.drop(final_df.columns[0]).to_numpy()
+            rows, cols = np.nonzero(matrix)
+            write_sparse_matrix(rows, cols, matrix[rows, cols], final_df[:, 0],
+                                final_df.columns[1:], args.output, args.format)
+        profiler.stop(rows_in=final_df.height, columns_in=final_df.width)
+        if not full: print_table_summary(args.output, final_df.height, final_df.width, stats)
+
+        if args.incremental:
+            hash_manifest['samples'] = sample_md5s
+            write_hash_manifest(hash_manifest_path(args.output), hash_manifest)
 
         print(f"Results written to {args.output}")
 
+class Command_Ranktable_Index(CommandLinePlugin):
+    command = 'ranktable_index'          # 'scripts <command>'
+    description = __doc__       # output with -h
+    usage = usage               # output with no args/bad args as well as -h
+    epilog = epilog             # output with -h
+    formatter_class = argparse.RawTextHelpFormatter # do not reformat multiline
+
+    def __init__(self, parser_index):
+        super().__init__(parser_index)
+
+        parser_index.add_argument('ranktable', help="Input csv containing classified hashes for specified organism")
+        parser_index.add_argument('-o', '--output', required=True, help="Directory to write the index to; pass it to hash_tables in place of the ranktable CSV.")
+        parser_index.add_argument('--scaled', nargs='+', type=int, default=[], help="Precompute the downsampled ranktable rows for each of these scaled values.")
+        parser_index.add_argument('-c', '--columns', nargs='+', default=None, help="Rank columns to keep alongside the hashvals in 'columns.parquet', for downstream use;\nhash_tables itself only reads the hashvals (default: all columns).")
+        parser_index.add_argument('-v', '--verbose', action='store_true', help="Please flood my terminal with output. Thx.")
+
+        debug_literal('RUNNING cmd_ranktable_index.__init__')
+
+    def main(self, args):
+        super().main(args)
+
+        print(f"Loading rabktable CSV '{args.ranktable}'...")
+        meta = build_ranktable_index(args.ranktable, args.output, scaled_values=args.scaled, columns=args.columns)
+        if args.verbose: print(json.dumps(meta, indent=1))
+        print(f"Indexed {meta['n_rows']} hashvals with columns {meta['columns']}")
+        for scaled, n_rows in meta['scaled'].items():
+            print(f"    scaled={scaled}: {n_rows} hashvals")
+        print(f"Index written to {args.output}")
+
 class Command_Compare_Rows(CommandLinePlugin):
     command = 'compare_rows'             # 'scripts <command>'
     description = __doc__       # output with -h
@@ -269,7 +466,11 @@ class Command_Compare_Rows(CommandLinePlugin):
 
         parser_compare.add_argument('datafile_1', nargs='?', metavar='FILE', help="A file that has the structure of the output from gather_tables, prefetch_tables, or hash_tables.")
         parser_compare.add_argument('datafile_2', nargs='?', metavar='FILE', help="A file that has the structure of the output from gather_tables, prefetch_tables, or hash_tables.")
+        parser_compare.add_argument('-o', '--output', default=None, help="Path to save the comparison (csv, csv.gz, parquet or ipc by extension).\nWithout it, the result is printed.")
+        parser_compare.add_argument('-m', '--mode', choices=['matches', 'count', 'jaccard', 'containment'], default='matches',
+                                    help="Value reported per sample pair: the ';'-separated shared rows ('matches'), their number ('count'),\nthe Jaccard similarity, or the containment of the row sample in the column sample (default: matches).")
         parser_compare.add_argument('-s', '--sort', action='store_true', help="Sort the column and rows.")
+        parser_compare.add_argument('--profile-json', metavar='FILE', default=None, help="Write the wall time, table shapes and peak memory (RSS) of each stage to FILE as JSON.")
         parser_compare.add_argument('-v', '--verbose', action='store_true', help="Please flood my terminal with output. Thx.")
 
         debug_literal('RUNNING cmd_compare_rows.__init__')
@@ -277,59 +478,382 @@ class Command_Compare_Rows(CommandLinePlugin):
     def main(self, args):
         super().main(args)
 
+        profiler = StageProfiler(args.profile_json, command=self.command)
+        try:
+            self.compare(args, profiler)
+            profiler.completed = True
+        finally:
+            profiler.write()
+
+    def compare(self, args, profiler):
+        profiler.start('load')
         print(f"Loading Data Files '{args.datafile_1}' and {args.datafile_2}...")
-        df1 = pl.read_csv(args.datafile_1)
-        df2 = pl.read_csv(args.datafile_2)
-       
-        if args.verbose: print(df1, '\n', df2)
-
-        df1_index = df1.columns[0]
-        df2_index = df2.columns[0]
-        if df1_index and df2_index not in ["hashval", "match_name"]:
-            raise ValueError("First column must be 'hashval' or 'match_name'.")
-
-        assert df1_index == df2_index
-        index = df1_index
-        df1_values = [col for col in df1.columns if col != df1_index]
-        df2_values = [col for col in df2.columns if col != df2_index]
-
-        print(f"Melting data...")
-        melted_df1 = df1.unpivot(
-            index=index,
-            on=df1_values,
-            variable_name="Identifier_1",
-            value_name="val1"
-        )
-
-        melted_df2 = df2.unpivot(
-            index=index,
-            on=df2_values,
-            variable_name="Identifier_2",
-            value_name="val2"
-        )
-        if args.verbose: print(melted_df1, '\n', melted_df2)
-
-        print("Finding all matches from presence data...")
-        matches = (
-            melted_df1
-            .join(melted_df2, on=index, how="full") #should this be inner join?
-            .filter((pl.col("val1") > 0) & (pl.col("val2") > 0))
-        )
-        if args.verbose: print(matches)
-
-        print("Reporting all matches for sample cross...")
-        result = (
-            matches
-            .group_by(["Identifier_1", "Identifier_2"])
-            .agg(pl.col(index).alias("matches"))
-            #.with_columns(pl.col("matches").list.join(",").fill_null("0"))
-            .pivot(values="matches", index="Identifier_1", on="Identifier_2")
-            .fill_null("0")
-        )
+        shared_bits = load_shared_bits(args.datafile_1, args.datafile_2)
+        if shared_bits is not None:
+            # both inputs are bitsets over the same distinct hashvals: intersect the words directly
+            ids, samples_1, bits_1, samples_2, bits_2 = shared_bits
+            print("Both inputs are bit-packed over the same hashvals; intersecting the words directly...")
+            profiler.stop(rows_in=2 * len(ids), columns_in=len(samples_1) + len(samples_2), rows_out=len(ids))
+
+            profiler.start('intersect')
+            print(f"Intersecting all sample pairs ({args.mode})...")
+            counts = bit_intersection_counts(bits_1, bits_2)
+            sizes_1 = popcount(bits_1).sum(axis=1, dtype=np.int64)
+            sizes_2 = popcount(bits_2).sum(axis=1, dtype=np.int64)
+            shared_ids = lambda i, j: bit_positions(bits_1[i] & bits_2[j])
+        else:
+            index_1, rows_1, samples_1, local_sets_1 = load_presence_sets(args.datafile_1)
+            index_2, rows_2, samples_2, local_sets_2 = load_presence_sets(args.datafile_2)
+            if args.verbose: print(rows_1, '\n', rows_2)
+
+            for df_index in (index_1, index_2):
+                if df_index != "hashval" and not df_index.startswith("match_name"):
+                    raise ValueError("First column must be 'hashval' or 'match_name'.")
+            if index_1 != index_2:
+                raise ValueError(f"Both files must have the same first column, not '{index_1}' and '{index_2}'.")
+            index = index_1
+
+            print("Indexing present rows per sample...")
+            ids = pl.concat([rows_1.to_frame(index), rows_2.to_frame(index)], how='vertical_relaxed')[index].unique(maintain_order=True)
+            sets_1 = to_shared_ids(rows_1, local_sets_1, ids)
+            sets_2 = to_shared_ids(rows_2, local_sets_2, ids)
+            profiler.stop(rows_in=len(rows_1) + len(rows_2), columns_in=len(samples_1) + len(samples_2), rows_out=len(ids))
+
+            profiler.start('intersect')
+            print(f"Intersecting all sample pairs ({args.mode})...")
+            counts = intersection_counts(sets_1, sets_2, len(ids))
+            sizes_1 = np.array([len(s) for s in sets_1], dtype=np.int64)
+            sizes_2 = np.array([len(s) for s in sets_2], dtype=np.int64)
+            shared_ids = lambda i, j: np.intersect1d(sets_1[i], sets_2[j], assume_unique=True)
+        if args.verbose: print(f"{len(ids)} distinct rows, {len(samples_1)} x {len(samples_2)} samples")
+
+        if args.mode == 'count':
+            values = counts
+        elif args.mode == 'jaccard':
+            union = sizes_1[:, None] + sizes_2[None, :] - counts
+            values = np.divide(counts, union, out=np.zeros(counts.shape), where=union > 0)
+        elif args.mode == 'containment':
+            sizes_1 = sizes_1[:, None]
+            values = np.divide(counts, sizes_1, out=np.zeros(counts.shape), where=sizes_1 > 0)
+        else:
+            # full match lists, only for the pairs that share something
+            ids_str = ids.cast(pl.String)
+            values = np.full(counts.shape, None, dtype=object)
+            for i, j in zip(*np.nonzero(counts)):
+                values[i, j] = ';'.join(ids_str.gather(shared_ids(i, j)))
+
+        result = pl.DataFrame(
+                [pl.Series("Identifier_1", samples_1)] +
+                [pl.Series(name, values[:, j].tolist()) for j, name in enumerate(samples_2)]
+                )
+        profiler.stop(rows_out=result.height, columns_out=result.width)
 
         if args.sort: result = result.sort("Identifier_1").select(["Identifier_1"] + sorted(result.columns[1:]))
         if args.verbose: print(result)
 
+        if args.output:
+            profiler.start('write')
+            output_format = 'csv.gz' if args.output.endswith('.gz') else table_file_format(args.output)
+            write_frame(result, args.output, output_format)
+            profiler.stop(rows_in=result.height, columns_in=result.width)
+            print(f"Results written to {args.output}")
+        else:
+            print(result)
+
+
+class Command_Tables_Bench(CommandLinePlugin):
+    command = 'tables_bench'             # 'scripts <command>'
+    description = __doc__       # output with -h
+    usage = usage               # output with no args/bad args as well as -h
+    epilog = epilog             # output with -h
+    formatter_class = argparse.RawTextHelpFormatter # do not reformat multiline
+
+    def __init__(self, parser_bench):
+        super().__init__(parser_bench)
+
+        parser_bench.add_argument('--data-dir', default='tables-bench', help="Directory for the synthetic cohort and the benchmark outputs (default: tables-bench).")
+        parser_bench.add_argument('-o', '--output', default=None, help="Path to save the results as JSON (default: '<data-dir>/results.json').")
+        parser_bench.add_argument('--files', type=int, default=50, help="Number of gather CSV files, one sample each (default: 50).")
+        parser_bench.add_argument('--matches', type=int, default=200, help="Number of matches per gather CSV file (default: 200).")
+        parser_bench.add_argument('--genomes', type=int, default=2000, help="Number of distinct reference genomes in the taxonomy (default: 2000).")
+        parser_bench.add_argument('--sketches', type=int, default=200, help="Number of sample sketches in the signature collection (default: 200).")
+        parser_bench.add_argument('--hashes', type=int, default=20000, help="Number of hashvals in the ranktable (default: 20000).")
+        parser_bench.add_argument('--seed', type=int, default=1, help="Random seed of the synthetic cohort (default: 1).")
+        parser_bench.add_argument('-b', '--benchmarks', nargs='+', choices=BENCHMARKS, default=list(BENCHMARKS), help="Benchmarks to run (default: all).")
+        parser_bench.add_argument('-r', '--repeat', type=int, default=3, help="Number of timed runs per benchmark; the fastest is reported (default: 3).")
+        parser_bench.add_argument('--baseline', default=None, metavar='JSON', help="Compare against an earlier results file and fail if a benchmark slowed down.")
+        parser_bench.add_argument('--max-slowdown', type=float, default=1.25, help="Largest allowed ratio of wall time to the --baseline wall time (default: 1.25).")
+        parser_bench.add_argument('-v', '--verbose', action='store_true', help="Please flood my terminal with output. Thx.")
+
+        debug_literal('RUNNING cmd_tables_bench.__init__')
+
+    def main(self, args):
+        super().main(args)
+
+        print(f"Generating a synthetic cohort in '{args.data_dir}': {args.files} files x {args.matches} matches "
+              f"of {args.genomes} genomes, {args.sketches} sketches over {args.hashes} hashvals...")
+        cohort = make_synthetic_cohort(args.data_dir, n_files=args.files, n_matches=args.matches,
+                                       n_genomes=args.genomes, n_sketches=args.sketches,
+                                       n_hashes=args.hashes, seed=args.seed)
+
+        results = []
+        scripts = [sys.executable, '-m', 'sourmash', 'scripts']
+        for name in args.benchmarks:
+            # inputs made by other commands are rebuilt every time, so they always match the cohort
+            for subcommand, arguments in benchmark_setup(name, cohort, args.data_dir):
+                subprocess.run(scripts + [subcommand] + arguments, check=True,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            subcommand, arguments = benchmark_command(name, cohort, args.data_dir)
+            cmd = scripts + [subcommand] + arguments
+            runs = [run_benchmark(cmd, os.path.join(args.data_dir, f"{name}.log")) for _ in range(args.repeat)]
+            failed = [run for run in runs if run['returncode'] != 0]
+            best = failed[0] if failed else min(runs, key=lambda run: run['wall_seconds'])
+            command = ' '.join(['sourmash', 'scripts', subcommand] + fold_cohort_files(arguments, cohort))
+            results.append(dict(benchmark=name, command=command, **best))
+            status = f"FAILED (see {name}.log)" if failed else \
+                     f"{best['wall_seconds']:.2f}s, peak RSS {best['max_rss_mb']:.0f} MB"
+            print(f"  {name:<16} {status}")
+
+        report = dict(scale=dict(files=args.files, matches=args.matches, genomes=args.genomes,
+                                 sketches=args.sketches, hashes=args.hashes, seed=args.seed),
+                      repeat=args.repeat,
+                      versions=dict(python=platform.python_version(), polars=pl.__version__,
+                                    numpy=np.__version__, sourmash=sourmash.VERSION),
+                      results=results)
+
+        output = args.output or os.path.join(args.data_dir, 'results.json')
+        with open(output, 'wt') as fp:
+            json.dump(report, fp, indent=1)
+        print(f"Results written to {output}")
+
+        failed = [result['benchmark'] for result in results if result['returncode'] != 0]
+        if args.baseline:
+            with open(args.baseline) as fp:
+                baseline = {result['benchmark']: result for result in json.load(fp)['results']}
+            for result in results:
+                previous = baseline.get(result['benchmark'])
+                if previous is None or result['returncode'] != 0 or previous['returncode'] != 0:
+                    continue
+                ratio = result['wall_seconds'] / max(previous['wall_seconds'], 1e-9)
+                print(f"  {result['benchmark']:<16} {ratio:.2f}x baseline")
+                if ratio > args.max_slowdown:
+                    failed.append(result['benchmark'])
+
+        if failed:
+            raise ValueError(f"Benchmarks failed or regressed: {', '.join(failed)}")
+
+
+def load_presence_sets(path):
+    """
+    Load a table and reduce each sample column to the positions of its present rows.
+
+    Bit-packed hash_tables output ('.bits') is read without going through a frame,
+    expanding only its non-zero words.
+
+    Returns:
+        tuple: (index name, index values as pl.Series, sample names, [sorted row arrays])
+    """
+    if table_file_format(path) == 'bits':
+        hashvals, samples, bits, n_rows = read_presence_bits(path)
+        return 'hashval', hashvals, samples, [bit_positions(words) for words in bits]
+
+    df = scan_table(path).collect()
+    index = df.columns[0]
+    samples = [col for col in df.columns if col != index]
+    sets = [np.flatnonzero((df[col] > 0).fill_null(False).to_numpy()) for col in samples]
+    return index, df[index], samples, sets
+
+def load_shared_bits(path_1, path_2):
+    """
+    Load two bit-packed hash_tables outputs for a direct word-by-word comparison.
+
+    This only applies when both files are '.bits' over the same hashvals in the same
+    order, each listed once; otherwise None is returned and the inputs go through
+    `load_presence_sets`.
+
+    Returns:
+        tuple: (hashvals, samples_1, bits_1, samples_2, bits_2) or None.
+    """
+    if table_file_format(path_1) != 'bits' or table_file_format(path_2) != 'bits':
+        return None
+    hashvals_1, samples_1, bits_1, n_rows_1 = read_presence_bits(path_1)
+    hashvals_2, samples_2, bits_2, n_rows_2 = read_presence_bits(path_2)
+    if not hashvals_1.equals(hashvals_2) or hashvals_1.n_unique() != len(hashvals_1):
+        return None
+    return hashvals_1, samples_1, bits_1, samples_2, bits_2
+
+def bit_intersection_counts(bits_1, bits_2):
+    """
+    Count the shared rows of every pair of samples as popcounts of the AND of their words.
+
+    Returns:
+        np.ndarray: A len(bits_1) x len(bits_2) matrix of intersection sizes.
+    """
+    counts = np.empty((len(bits_1), len(bits_2)), dtype=np.int64)
+    for i, words in enumerate(bits_1):
+        counts[i] = popcount(bits_2 & words).sum(axis=1, dtype=np.int64)
+    return counts
+
+def to_shared_ids(index_values, row_sets, ids):
+    """
+    Translate per-table row positions into positions in `ids`, shared by both tables.
+
+    Repeated index values map to the same id and are counted once, so set sizes
+    and intersections stay those of the distinct rows.
+
+    Returns:
+        list: One sorted np.ndarray of distinct ids per sample.
+    """
+    name = index_values.name
+    id_codes = pl.DataFrame({name: ids, '_id': pl.int_range(len(ids), eager=True)})
+    row_ids = (
+            index_values.cast(ids.dtype).to_frame(name)
+            .join(id_codes, on=name, how='left', maintain_order='left')['_id']
+            .to_numpy()
+            )
+    return [np.unique(row_ids[rows]) for rows in row_sets]
+
+def intersection_counts(sets_1, sets_2, n_ids):
+    """
+    Count the shared ids of every pair of samples with one sparse matrix product.
+
+    Returns:
+        np.ndarray: A len(sets_1) x len(sets_2) matrix of intersection sizes.
+    """
+    def indicator(sets):
+        indptr = np.zeros(len(sets) + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in sets], out=indptr[1:])
+        indices = np.concatenate(sets) if sets else np.empty(0, dtype=np.int64)
+        data = np.ones(len(indices), dtype=np.int32)
+        return scipy.sparse.csr_matrix((data, indices, indptr), shape=(len(sets), n_ids))
+
+    return (indicator(sets_1) @ indicator(sets_2).T).toarray()
+
+# sparse matrix exports, selected with --format
+SPARSE_MATRIX_FORMATS = ('mtx', 'npz')
+
+# output containers for gather_tables and prefetch_tables
+OUTPUT_FORMATS = ('csv', 'csv.gz', 'parquet', 'ipc')
+
+def table_file_format(path):
+    """
+    Guess the container of a table file from its extension: 'parquet', 'ipc', 'bits' or 'csv'.
+    """
+    name = path.lower()
+    if name.endswith(('.parquet', '.pq')):
+        return 'parquet'
+    if name.endswith(('.arrow', '.ipc', '.feather')):
+        return 'ipc'
+    if name.endswith('.bits'):
+        return 'bits'
+    return 'csv'
+
+def resolve_output_format(output, output_format=None, gzip=False):
+    """
+    Decide the container gather_tables/prefetch_tables write to.
+
+    Without `--output-format` it follows the extension of `output` ('.gz' is csv.gz),
+    as compare_rows does; '-z' asks for csv.gz and cannot be combined with another
+    container. An explicit `--output-format` that disagrees with the extension wins,
+    with a warning.
+
+    Returns:
+        str: One of `OUTPUT_FORMATS`.
+    """
+    inferred = 'csv.gz' if output.lower().endswith('.gz') else table_file_format(output)
+    if inferred not in OUTPUT_FORMATS:
+        inferred = 'csv'
+
+    if gzip:
+        requested = output_format or inferred
+        if requested not in ('csv', 'csv.gz'):
+            raise ValueError(f"-z writes csv.gz and cannot be combined with {requested} output ('{output}').")
+        return 'csv.gz'
+
+    if output_format is None:
+        return inferred
+    # '.gz' is appended to csv.gz output, so a '.csv' name is fine for it
+    mismatch = inferred != output_format and not (output_format == 'csv.gz' and inferred == 'csv')
+    if mismatch and (inferred != 'csv' or output.lower().endswith('.csv')):
+        print(f"WARNING: writing {output_format} output to '{output}', whose extension suggests {inferred}.")
+    return output_format
+
+def scan_table(path):
+    """
+    Lazily scan a CSV, parquet or Arrow IPC file; IPC files are memory-mapped.
+    """
+    file_format = table_file_format(path)
+    if file_format == 'parquet':
+        return pl.scan_parquet(path)
+    elif file_format == 'ipc':
+        return pl.scan_ipc(path)
+    elif path.endswith('.gz'):
+        # scan_csv cannot decompress
+        return pl.read_csv(path, separator=',', has_header=True).lazy()
+    return pl.scan_csv(path, separator=',', has_header=True)
+
+# cells per chunk of a gzipped CSV, each serialized and compressed on its own thread
+GZIP_CHUNK_CELLS = 2_000_000
+# chunks queued for compression at once, whatever the thread count, so memory stays a few chunks
+GZIP_CHUNKS_IN_FLIGHT = 4
+
+def write_frame(df, output, output_format='csv', cores=None, stats=None):
+    """
+    Write `df` to `output` as csv, gzipped csv, or zstd-compressed parquet/Arrow IPC.
+
+    Gzipped CSV is written in row chunks compressed in parallel on `cores` threads
+    (see `write_gzip_members`). If given, `stats` (a `TableStats`) is updated with
+    each chunk as it is handed to the writer.
+    """
+    if output_format == 'csv.gz':
+        chunk_rows = max(1, GZIP_CHUNK_CELLS // max(df.width, 1))
+        chunks = (df.slice(start, chunk_rows) for start in range(0, max(df.height, 1), chunk_rows))
+        if stats is not None:
+            chunks = map(stats.update, chunks)
+        write_gzip_members(chunks, output, cores=cores)
+        return
+
+    if stats is not None:
+        stats.update(df)
+    if output_format == 'csv':
+        df.write_csv(output)
+    elif output_format == 'parquet':
+        df.write_parquet(output, compression='zstd')
+    elif output_format == 'ipc':
+        df.write_ipc(output, compression='zstd')
+    else:
+        raise ValueError(f"Unknown output format: {output_format}")
+
+def _gzip_csv_member(df, include_header, compresslevel):
+    buf = io.BytesIO()
+    df.write_csv(buf, include_header=include_header)
+    return gzip.compress(buf.getvalue(), compresslevel=compresslevel, mtime=0)
+
+def write_gzip_members(chunks, output, cores=None, compresslevel=6):
+    """
+    Write row chunks of one table as a gzipped CSV, serializing and compressing them in parallel.
+
+    Every chunk becomes an independent gzip member and the members are written in
+    order. A concatenation of gzip members is a single valid gzip file (RFC 1952), so
+    `gzip -d`, `zcat`, R and polars read the result as one CSV. At most
+    `GZIP_CHUNKS_IN_FLIGHT` chunks and their compressed bytes are queued at once,
+    independent of `cores`, plus the chunk `chunks` is producing.
+
+    Parameters:
+        chunks (iterable): DataFrames with the same columns; only the first writes the header.
+        output (str): Path of the .gz file.
+        cores (int): Number of compression threads (default: all CPUs, at most `GZIP_CHUNKS_IN_FLIGHT`).
+        compresslevel (int): zlib compression level.
+    """
+    n_threads = min(cores or os.cpu_count() or 1, GZIP_CHUNKS_IN_FLIGHT)
+    with open(output, 'wb') as fp, ThreadPoolExecutor(max_workers=n_threads) as executor:
+        pending = collections.deque()
+        for n, chunk_df in enumerate(chunks):
+            pending.append(executor.submit(_gzip_csv_member, chunk_df, n == 0, compresslevel))
+            if len(pending) >= GZIP_CHUNKS_IN_FLIGHT:
+                fp.write(pending.popleft().result())
+        while pending:
+            fp.write(pending.popleft().result())
 
 def numeric_type(x):
     try:
@@ -346,13 +870,871 @@ def read_file_and_separate(file_path):
 
     return header, idx
 
-def process_file(filename, column_selection, output_format="dense", lineage_rank='species', filter_rows=None, presence=False, taxdb=None):
+def read_column_groups(paths):
+    """
+    Read every --collapse-columns/--extract-columns file up front.
+
+    Parameters:
+        paths (list): Text files whose first line is the group name and remaining lines are column names.
+
+    Returns:
+        list: A (header, members, path) tuple per file.
+    """
+    groups = []
+    for path in paths:
+        header, members = read_file_and_separate(path)
+        groups.append((header, members, path))
+    return groups
+
+def group_indicator(sample_names, groups, verbose=False):
+    """
+    Build the sparse (samples x groups) indicator matrix mapping each sample column to the groups listing it.
+
+    Members that are not sample columns are ignored and groups with no matching sample are
+    skipped. A column listed twice in one group counts twice, and a repeated group name
+    replaces the earlier group, as the per-group `with_columns()` loop did.
+
+    Parameters:
+        sample_names (list): The sample column names, in matrix order.
+        groups (list): The output of `read_column_groups`.
+        verbose (bool): Print the members of each group.
+
+    Returns:
+        tuple: (group_names, indicator) where `indicator` is a scipy.sparse.csr_array.
+    """
+    sample_index = {name: j for j, name in enumerate(sample_names)}
+    group_members = {}
+    for header, members, path in groups:
+        print(f"Processing: {path}")
+        if verbose: print(f"First line: {header}")
+        if verbose: print(f"Remaining lines: {members}")
+
+        existing_columns = [sample_index[col] for col in members if col in sample_index]
+        if verbose: print([sample_names[j] for j in existing_columns])
+
+        if existing_columns:
+            group_members[header] = existing_columns
+            print(f"... Updating DataFrame with {header}")
+        else:
+            print(f"No matching columns found for {path}, skipping...")
+
+    group_names = list(group_members)
+    samples = np.fromiter((j for members in group_members.values() for j in members), dtype=np.int64)
+    group_cols = np.repeat(np.arange(len(group_names)), [len(members) for members in group_members.values()])
+    indicator = scipy.sparse.coo_array((np.ones(len(samples), dtype=np.int32), (samples, group_cols)),
+                                       shape=(len(sample_names), len(group_names))).tocsr()
+    return group_names, indicator
+
+def collapse_column_groups(matrix, sample_names, groups, verbose=False):
+    """
+    Sum every group of sample columns in a single sparse indicator product.
+
+    Shared by hash_tables and gather_tables/prefetch_tables --collapse-columns.
+
+    Parameters:
+        matrix (np.ndarray or scipy.sparse array): A (rows x samples) table of values.
+        sample_names (list): The sample column names, in matrix order.
+        groups (list): The output of `read_column_groups`.
+        verbose (bool): Print the members of each group.
+
+    Returns:
+        tuple: (group_names, sums) where `sums` is a dense (rows x groups) array with the dtype of `matrix`.
+    """
+    group_names, indicator = group_indicator(sample_names, groups, verbose=verbose)
+    sums = matrix @ indicator.astype(matrix.dtype)
+    if scipy.sparse.issparse(sums):
+        sums = sums.toarray()
+    return group_names, np.asarray(sums)
+
+def extract_column_groups(df, index_col, groups, verbose=False):
+    """
+    Keep the index column and every group's columns in one projection, then drop all-zero rows.
+
+    Parameters:
+        df (pl.DataFrame): The dense table.
+        index_col (str): The column holding the row names.
+        groups (list): The output of `read_column_groups`.
+        verbose (bool): Print the members of each group.
+
+    Returns:
+        pl.DataFrame: The extracted table, columns in the order the groups list them.
+    """
+    columns = []
+    for header, members, path in groups:
+        print(f"Processing: {path}")
+        if verbose: print(f"First line: {header}")
+        if verbose: print(f"Remaining lines: {members}")
+
+        existing_columns = [col for col in members if col in df.columns and col != index_col]
+        if verbose: print(existing_columns)
+
+        if existing_columns:
+            columns.extend(existing_columns)
+            print(f"... Updating DataFrame with columns from {header}")
+        else:
+            print(f"No matching columns found for {path}, skipping...")
+
+    columns = list(dict.fromkeys(columns))
+    if not columns:
+        return df.select(index_col).clear()
+    return df.select([index_col] + columns).filter(pl.any_horizontal(pl.col(columns) != 0))
+
+def build_hashval_index(hashvals):
+    """
+    Sort the ranktable hashvals once so sketch hashes can be mapped to rows in bulk.
+
+    Parameters:
+        hashvals (pl.Series or np.ndarray): The 'hashval' column of the ranktable.
+
+    Returns:
+        tuple: (sorted_hashvals, order) where `sorted_hashvals` is a sorted uint64 array
+               and `order[i]` is the ranktable row of `sorted_hashvals[i]`.
+    """
+    if isinstance(hashvals, pl.Series):
+        hashvals = hashvals.cast(pl.UInt64).to_numpy()
+    hashvals = np.asarray(hashvals).astype(np.uint64, copy=False)
+    order = np.argsort(hashvals, kind='stable')
+    return hashvals[order], order
+
+RANKTABLE_INDEX_META = 'meta.json'
+
+def is_ranktable_index(path):
+    """
+    Return True if `path` is a ranktable index directory written by `build_ranktable_index`.
+    """
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, RANKTABLE_INDEX_META))
+
+def max_hash_for_scaled(scaled):
+    """
+    Return the largest hash a sketch keeps at `scaled`, as sourmash computes it.
+    """
+    if scaled == 0:
+        return 0
+    return min(int(round((2**64 - 1) / scaled, 0)), 2**64 - 1)
+
+def hashval_series(hashvals, dtype):
+    """
+    Wrap the ranktable hashvals (a numpy array, possibly memory-mapped) as the output 'hashval' column.
+    """
+    return pl.Series('hashval', np.asarray(hashvals)).cast(dtype)
+
+def downsampled_rows(hash_index, scaled):
+    """
+    Find the ranktable rows whose hashval survives downsampling to `scaled`.
+
+    The sorted hashvals below the scaled max_hash are a prefix of the index,
+    so this is one `np.searchsorted` and a sort of the surviving rows.
+
+    Parameters:
+        hash_index (tuple): The output of `build_hashval_index`.
+        scaled (int): The scaled value to downsample to.
+
+    Returns:
+        np.ndarray: Sorted ranktable row indices.
+    """
+    sorted_hashvals, order = hash_index
+    n_kept = np.searchsorted(sorted_hashvals, np.uint64(max_hash_for_scaled(scaled)), side='right')
+    return np.sort(order[:n_kept])
+
+def downsample_ranktable(hashvals, hash_index, scaled, rows_path=None):
+    """
+    Restrict the ranktable hashvals and their index to those kept at `scaled`.
+
+    Parameters:
+        hashvals (np.ndarray): The ranktable hashvals, in ranktable order.
+        hash_index (tuple): The output of `build_hashval_index` for `hashvals`.
+        scaled (int): The scaled value to downsample to.
+        rows_path (str): Optional precomputed `downsampled_rows` from a ranktable index.
+
+    Returns:
+        tuple: (hashvals, hash_index) for the kept rows, in ranktable order.
+    """
+    if rows_path is not None:
+        rows = np.load(rows_path, mmap_mode='r')
+    else:
+        rows = downsampled_rows(hash_index, scaled)
+    sorted_hashvals, order = hash_index
+    n_kept = len(rows)
+    # the kept hashvals are a prefix of the sorted index; renumber their rows
+    order = np.searchsorted(rows, order[:n_kept])
+    return hashvals[np.asarray(rows)], (sorted_hashvals[:n_kept], order)
+
+def build_ranktable_index(ranktable, output, scaled_values=(), columns=None):
+    """
+    Precompile a ranktable CSV into a directory of arrays hash_tables can memory-map.
+
+    The index holds the hashvals in ranktable order ('hashvals.npy'), sorted with their
+    ranktable rows ('sorted_hashvals.npy', 'order.npy'), the downsampled rows for each
+    of `scaled_values` ('scaled-<scaled>.npy') and a 'meta.json' describing the source CSV.
+
+    The retained rank columns are written to 'columns.parquet', row-aligned with
+    'hashvals.npy'. hash_tables does not read them; they are kept for downstream
+    consumers, e.g. to label the rows of a hash_tables output without the CSV.
+
+    Parameters:
+        ranktable (str): Path to the ranktable CSV with a 'hashval' column.
+        output (str): Directory to write the index to.
+        scaled_values (list): Scaled values to precompute downsampled views for.
+        columns (list): Rank columns to keep (default: all but 'hashval').
+
+    Returns:
+        dict: The index metadata.
+    """
+    ranktable_df = pl.read_csv(ranktable)
+    if 'hashval' not in ranktable_df.columns:
+        raise ValueError(f"Ranktable '{ranktable}' has no 'hashval' column.")
+    if columns is None:
+        columns = [col for col in ranktable_df.columns if col != 'hashval']
+    missing = [col for col in columns if col not in ranktable_df.columns]
+    if missing:
+        raise ValueError(f"Ranktable '{ranktable}' has no columns {missing}.")
+
+    hashvals = ranktable_df['hashval']
+    hash_index = build_hashval_index(hashvals)
+
+    os.makedirs(output, exist_ok=True)
+    np.save(os.path.join(output, 'hashvals.npy'), hashvals.cast(pl.UInt64).to_numpy().astype(np.uint64, copy=False))
+    np.save(os.path.join(output, 'sorted_hashvals.npy'), hash_index[0])
+    np.save(os.path.join(output, 'order.npy'), hash_index[1])
+    ranktable_df.select(columns).write_parquet(os.path.join(output, 'columns.parquet'))
+
+    views = {}
+    for scaled in sorted(set(scaled_values)):
+        rows = downsampled_rows(hash_index, scaled)
+        np.save(os.path.join(output, f'scaled-{scaled}.npy'), rows)
+        views[str(scaled)] = len(rows)
+
+    stat = os.stat(ranktable)
+    meta = dict(source=os.path.abspath(ranktable), size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                n_rows=len(hashvals), hashval_dtype=str(hashvals.dtype), columns=columns, scaled=views)
+    with open(os.path.join(output, RANKTABLE_INDEX_META), 'wt') as fp:
+        json.dump(meta, fp, indent=1)
+    return meta
+
+def load_ranktable_index(path, verbose=False):
+    """
+    Memory-map a ranktable index written by `build_ranktable_index`.
+
+    Nothing is copied here: the hashvals stay a read-only memory map until
+    `hashval_series` turns them into an output column.
+
+    Returns:
+        tuple: (hashvals, dtype, hash_index, views) where `hashvals` is the memory-mapped
+               uint64 array, `dtype` the polars dtype of the CSV's 'hashval' column,
+               `hash_index` matches `build_hashval_index`, and `views` maps each
+               precomputed scaled value to its downsampled rows file.
+    """
+    with open(os.path.join(path, RANKTABLE_INDEX_META), 'rt') as fp:
+        meta = json.load(fp)
+    if verbose: print(json.dumps(meta, indent=1))
+
+    source = meta['source']
+    if os.path.exists(source):
+        stat = os.stat(source)
+        if (stat.st_size, stat.st_mtime_ns) != (meta['size'], meta['mtime_ns']):
+            print(f"WARNING: '{source}' changed since the index '{path}' was built; rebuild it with ranktable_index.")
+
+    hashvals = np.load(os.path.join(path, 'hashvals.npy'), mmap_mode='r')
+    hash_index = (np.load(os.path.join(path, 'sorted_hashvals.npy'), mmap_mode='r'),
+                  np.load(os.path.join(path, 'order.npy'), mmap_mode='r'))
+    views = {int(scaled): os.path.join(path, f'scaled-{scaled}.npy') for scaled in meta['scaled']}
+    return hashvals, getattr(pl, meta['hashval_dtype']), hash_index, views
+
+def map_hashes_to_rows(hash_index, hashes, return_index=False):
+    """
+    Find the ranktable rows of every hash in `hashes` with a single `np.searchsorted`.
+
+    Parameters:
+        hash_index (tuple): The output of `build_hashval_index`.
+        hashes (iterable): Hash values of a sketch, e.g. `minhash.hashes`.
+        return_index (bool): Also return, for each row, the position of its hash in `hashes`.
+
+    Returns:
+        np.ndarray: Sorted ranktable row indices present in the sketch,
+                    or a tuple (rows, positions) with `return_index`.
+    """
+    sorted_hashvals, order = hash_index
+    hashes = np.fromiter(hashes, dtype=np.uint64)
+    if not len(hashes) or not len(sorted_hashvals):
+        empty = np.empty(0, dtype=np.int64)
+        return (empty, empty) if return_index else empty
+
+    left = np.searchsorted(sorted_hashvals, hashes, side='left')
+    right = np.searchsorted(sorted_hashvals, hashes, side='right')
+    counts = right - left
+    hit = counts > 0
+    left, counts = left[hit], counts[hit]
+    positions = np.flatnonzero(hit)
+
+    if len(counts) and counts.max() > 1:
+        # duplicate hashvals in the ranktable: every copy is marked present
+        starts = np.repeat(left - np.cumsum(counts) + counts, counts)
+        left = starts + np.arange(counts.sum())
+        positions = np.repeat(positions, counts)
+
+    rows = order[left]
+    if not return_index:
+        return np.sort(rows)
+    by_row = np.argsort(rows, kind='stable')
+    return rows[by_row], positions[by_row]
+
+def iter_sketch_rows(filename, hash_index, select_kw, scaled=None, filter_by_name=None, known_md5s=None, stats=None,
+                     abundance=None, seen=None):
+    """
+    Lazily map each selected signature of one sketch file to the ranktable rows it contains.
+
+    The ksize/moltype/scaled selection and the sample names are pushed down into the
+    collection manifest, so zip, sqlite and manifest-backed collections only load the
+    matching signatures. These are pulled one at a time, downsampled and mapped, so only
+    the compact row arrays outlive each iteration.
+
+    Parameters:
+        filename (str): Path to any sketch collection sourmash can load.
+        hash_index (tuple): The output of `build_hashval_index`.
+        select_kw (dict): ksize/moltype/scaled/abund passed to `Index.select`.
+        scaled (int): Downsample every signature to this scaled value.
+        filter_by_name (set): Optional set of sample names to keep.
+        known_md5s (dict): With --incremental, sample name -> md5sum of the sketches already
+                           in the output; matching signatures are not mapped again. Where the
+                           collection has a manifest (zip, sqlite, ...) they are excluded
+                           through a md5 picklist and never loaded.
+        stats (dict): Optional 'selected', 'skipped' and 'unchanged' counters, updated in place.
+        abundance (str): 'count' or 'normalized' to also return each row's hash abundance,
+                         or its abundance divided by the sketch's summed abundance.
+        seen (set): With `known_md5s`, updated in place with the name of every selected
+                    signature, mapped or unchanged.
+
+    Yields:
+        tuple: (name, md5sum, rows, values) where `rows` is a compact array of row indices,
+               `values` the matching abundances (None without `abundance`), and `md5sum`
+               is None unless `known_md5s` is given.
+    """
+    if stats is None:
+        stats = dict(selected=0, skipped=0, unchanged=0)
+    n_rows = len(hash_index[0])
+    row_dtype = np.uint32 if n_rows < 2**32 else np.int64
+
+    idx = sourmash.load_file_as_index(filename)
+    idx = idx.select(**select_kw)
+    if filter_by_name:
+        n_available = len(idx)
+        idx = idx.select(picklist=name_picklist(filter_by_name))
+        stats['skipped'] += n_available - len(idx)
+    stats['selected'] += len(idx)
+
+    manifest = getattr(idx, 'manifest', None) if known_md5s is not None else None
+    if manifest is not None:
+        # compare against the manifest md5s, so unchanged sketches are never loaded
+        manifest_rows = list(manifest.rows)
+        if seen is not None: seen.update(row['name'] for row in manifest_rows)
+        if any(known_md5s.get(row['name']) == row['md5'] for row in manifest_rows):
+            changed = {row['md5'] for row in manifest_rows if known_md5s.get(row['name']) != row['md5']}
+            n_available = len(idx)
+            idx = idx.select(picklist=md5_picklist(changed))
+            stats['unchanged'] += n_available - len(idx)
+
+    for metag_ss in idx.signatures():
+        metag_name = metag_ss.name
+        md5sum = None
+        if known_md5s is not None:
+            md5sum = metag_ss.md5sum()
+            if seen is not None: seen.add(metag_name)
+            # unchanged sketches reach here without a manifest, or when they share a changed sketch's md5
+            if known_md5s.get(metag_name) == md5sum:
+                stats['unchanged'] += 1
+                continue
+
+        metag_mh = metag_ss.minhash.downsample(scaled=scaled)
+        values = None
+        if abundance:
+            hashes = metag_mh.hashes
+            rows, positions = map_hashes_to_rows(hash_index, hashes.keys(), return_index=True)
+            abunds = np.fromiter(hashes.values(), dtype=np.int64, count=len(hashes))
+            if abundance == 'normalized':
+                values = abunds[positions] / abunds.sum()
+            else:
+                values = abunds[positions].astype(np.int32)
+        else:
+            rows = map_hashes_to_rows(hash_index, metag_mh.hashes)
+        yield metag_name, md5sum, rows.astype(row_dtype), values
+
+def name_picklist(names):
+    """
+    Build a sourmash picklist selecting signatures by exact name.
+    """
+    picklist = SignaturePicklist('name')
+    picklist.init(names)
+    return picklist
+
+def md5_picklist(md5s):
+    """
+    Build a sourmash picklist selecting signatures by md5sum.
+    """
+    picklist = SignaturePicklist('md5')
+    picklist.init(md5s)
+    return picklist
+
+def map_sketch_file(filename, hash_index, **kwargs):
+    """
+    Map every selected signature of one sketch file; used by the --cores worker processes,
+    which must hand back their results in one piece.
+
+    Returns:
+        tuple: ([(name, md5sum, rows, values), ...], {'selected': int, 'skipped': int, 'unchanged': int},
+                set of the selected sample names)
+    """
+    stats = dict(selected=0, skipped=0, unchanged=0)
+    seen = set()
+    hits = list(iter_sketch_rows(filename, hash_index, stats=stats, seen=seen, **kwargs))
+    return hits, stats, seen
+
+def hashval_digest(hashvals):
+    """
+    Fingerprint the ranktable hashvals (a numpy array), in order, for the --incremental manifest.
+    """
+    return hashlib.sha1(np.ascontiguousarray(hashvals, dtype='<u8').tobytes()).hexdigest()
+
+def hash_manifest_path(output):
+    """
+    Return the --incremental manifest of a hash_tables output, e.g. 'presence.parquet.manifest.json'.
+    """
+    return output + '.manifest.json'
+
+def read_hash_manifest(path):
+    """
+    Read a hash_tables manifest, or return None if there is none.
+
+    The manifest holds 'ranktable_digest', 'scaled', 'ksize', 'moltype' and
+    'samples', a mapping of sample name to sketch md5sum.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rt') as fp:
+        return json.load(fp)
+
+def write_hash_manifest(path, manifest):
+    with open(path, 'wt') as fp:
+        json.dump(manifest, fp, indent=1)
+
+# per-process copy of the hashval index, set once by the pool initializer
+_worker_hash_index = None
+
+def _init_sketch_worker(hash_index):
+    global _worker_hash_index
+    _worker_hash_index = hash_index
+
+def _map_sketch_file_worker(filename, **kwargs):
+    return map_sketch_file(filename, _worker_hash_index, **kwargs)
+
+def popcount(words):
+    """
+    Count the set bits of each uint64 word.
+    """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    # numpy < 2.0
+    as_bytes = words.view(np.uint8).reshape(words.shape + (8,))
+    return np.unpackbits(as_bytes, axis=-1).sum(axis=-1, dtype=np.uint8)
+
+def unpack_bits(words, n_rows):
+    """
+    Expand bit-packed presence words (one row of uint64 words per sample) to 0/1 uint8 values.
+    """
+    as_bytes = np.ascontiguousarray(words, dtype='<u8').view(np.uint8)
+    return np.unpackbits(as_bytes, axis=-1, bitorder='little')[..., :n_rows]
+
+def write_presence_bits(output, hashvals, names, bits):
+    """
+    Write a bit-packed presence matrix as an uncompressed .npz archive.
+
+    The archive holds 'hashval', the sample 'names', 'n_rows' and 'bits', a
+    (samples x words) uint64 array where bit `r % 64` of word `r // 64` marks row `r`.
+    """
+    with open(output, 'wb') as fp:
+        np.savez(fp, hashval=hashvals.to_numpy(), names=np.array(names, dtype=str),
+                 n_rows=np.array(len(hashvals)), bits=bits)
+
+def read_presence_bits(path):
+    """
+    Read a presence matrix written by `write_presence_bits`.
+
+    Returns:
+        tuple: (hashvals as pl.Series, sample names, bits, n_rows)
+    """
+    with np.load(path) as archive:
+        return (pl.Series('hashval', archive['hashval']), archive['names'].tolist(),
+                archive['bits'], int(archive['n_rows']))
+
+def pack_rows(rows, n_rows):
+    """
+    Pack sorted row indices into one uint64 word per 64 rows, bit `r % 64` of word `r // 64` marking row `r`.
+    """
+    flags = np.zeros(((n_rows + 63) // 64) * 64, dtype=bool)
+    flags[rows] = True
+    return np.packbits(flags, bitorder='little').view('<u8').astype(np.uint64, copy=False)
+
+def bit_positions(words):
+    """
+    Return the sorted positions of the set bits in a row of uint64 words.
+
+    Only the non-zero words are expanded, so sparse bitsets are not decoded in full.
+    """
+    nonzero = np.flatnonzero(words)
+    as_bytes = np.ascontiguousarray(words[nonzero], dtype='<u8').view(np.uint8).reshape(-1, 8)
+    word_idx, bit_idx = np.nonzero(np.unpackbits(as_bytes, axis=1, bitorder='little'))
+    return nonzero[word_idx] * 64 + bit_idx
+
+class PresenceMatrix:
+    """
+    Presence of ranktable rows per sample, each sample stored in whichever form is smaller.
+
+    A sample keeps the row indices of the hashes found in it (32 bits per hit, 64 past
+    2**32 rows) until it has more than one hit per 32 rows (one per 64 with 64-bit
+    indices). Beyond that density the indices cost more than a bitset, so the sample
+    is packed into one uint64 word per 64 rows instead. Memory per sample is thus
+    bounded by both its hits and n_rows / 8 bytes. Packed samples go to `to_bits` as
+    they are and are popcounted by `counts`; they are only decoded to row indices
+    for the sparse and dense outputs.
+
+    With `dtype` set, each sample also carries one value per row (e.g. hash abundances)
+    instead of an implicit 1, and keeps its row indices.
+    """
+
+    def __init__(self, n_rows, dtype=None):
+        self.n_rows = n_rows
+        self.n_words = (n_rows + 63) // 64
+        self.dtype = dtype
+        self._rows = {}
+        self._packed = set()
+        self._values = {}
+
+    def __len__(self):
+        return len(self._rows)
+
+    @property
+    def names(self):
+        return list(self._rows)
+
+    @property
+    def nnz(self):
+        return int(self.counts().sum())
+
+    def add(self, name, rows, values=None):
+        # a repeated sample name replaces the earlier column, as with_columns() did
+        rows = np.asarray(rows)
+        self._packed.discard(name)
+        if self.dtype is not None:
+            self._values[name] = np.asarray(values, dtype=self.dtype)
+        elif rows.nbytes > self.n_words * 8:
+            rows = pack_rows(rows, self.n_rows)
+            self._packed.add(name)
+        self._rows[name] = rows
+
+    def counts(self):
+        """
+        Returns:
+            np.ndarray: The number of present rows of each sample.
+        """
+        return np.array([popcount(rows).sum(dtype=np.int64) if name in self._packed else len(rows)
+                         for name, rows in self._rows.items()], dtype=np.int64)
+
+    def sample_rows(self):
+        """
+        Returns:
+            list: The sorted row indices of each sample, decoding packed samples.
+        """
+        return [bit_positions(rows) if name in self._packed else rows for name, rows in self._rows.items()]
+
+    def to_values(self):
+        """
+        Returns:
+            np.ndarray: The value of every entry, in `to_csr`/`to_coo` order (all ones without `dtype`).
+        """
+        if self.dtype is None:
+            return np.ones(self.nnz, dtype=np.int32)
+        if not self._values:
+            return np.empty(0, dtype=self.dtype)
+        return np.concatenate(list(self._values.values()))
+
+    def to_sparse(self):
+        """
+        Returns:
+            scipy.sparse.csr_array: A (samples x n_rows) matrix of the entry values.
+        """
+        indptr, indices = self.to_csr()
+        return scipy.sparse.csr_array((self.to_values(), indices, indptr), shape=(len(self), self.n_rows))
+
+    def to_csr(self):
+        """
+        Returns:
+            tuple: (indptr, indices) with one CSR row per sample, in insertion order.
+        """
+        sample_rows = self.sample_rows()
+        indptr = np.zeros(len(sample_rows) + 1, dtype=np.int64)
+        np.cumsum([len(rows) for rows in sample_rows], out=indptr[1:])
+        if sample_rows:
+            indices = np.concatenate(sample_rows)
+        else:
+            indices = np.empty(0, dtype=np.int64)
+        return indptr, indices
+
+    def to_coo(self):
+        """
+        Returns:
+            tuple: (rows, cols) ranktable row and sample column of every present hash.
+        """
+        indptr, indices = self.to_csr()
+        return indices, np.repeat(np.arange(len(self)), np.diff(indptr))
+
+    def to_bits(self):
+        """
+        Returns:
+            np.ndarray: A (samples x ceil(n_rows / 64)) uint64 array, bit `r % 64` of word `r // 64` set
+                        when row `r` is present.
+        """
+        bits = np.zeros((len(self), self.n_words), dtype=np.uint64)
+        for j, (name, rows) in enumerate(self._rows.items()):
+            bits[j] = rows if name in self._packed else pack_rows(rows, self.n_rows)
+        return bits
+
+    def group_sums(self, indicator):
+        """
+        Sum the samples into groups one sample at a time, without decoding them all at once.
+
+        Packed samples are unpacked to one byte per row and added column by column; peak
+        memory is the (n_rows x groups) accumulator plus a single decoded sample.
+
+        Parameters:
+            indicator (scipy.sparse.csr_array): The (samples x groups) output of `group_indicator`.
+
+        Returns:
+            np.ndarray: A (n_rows x groups) array, int32 for presence or `dtype` for values.
+        """
+        indicator = scipy.sparse.csr_array(indicator)
+        sums = np.zeros((self.n_rows, indicator.shape[1]), dtype=self.dtype or np.int32, order='F')
+        for j, (name, rows) in enumerate(self._rows.items()):
+            start, stop = indicator.indptr[j], indicator.indptr[j + 1]
+            if start == stop:
+                continue
+            if name in self._packed:
+                sample = unpack_bits(rows, self.n_rows)
+            for group, weight in zip(indicator.indices[start:stop], indicator.data[start:stop]):
+                if name in self._packed:
+                    sums[:, group] += sample * sums.dtype.type(weight)
+                elif self.dtype is not None:
+                    sums[rows, group] += self._values[name] * weight
+                else:
+                    sums[rows, group] += weight
+        return sums
+
+    def to_frame(self, hashvals):
+        """
+        Build the dense presence frame: `hashvals` followed by one 0/1 (or value) column per sample.
+        """
+        columns = [hashvals]
+        for name, rows in self._rows.items():
+            if name in self._packed:
+                column = unpack_bits(rows, self.n_rows).astype(np.int32)
+            else:
+                column = np.zeros(self.n_rows, dtype=self.dtype or np.int32)
+                column[rows] = self._values[name] if self.dtype is not None else 1
+            columns.append(pl.Series(name, column))
+        return pl.DataFrame(columns)
+
+# string columns kept alongside the numeric ones in the --cache-dir parquet files
+CACHED_NAME_COLUMNS = ('query_name', 'match_name', 'name')
+
+def cached_parquet_path(filename, cache_dir, kind=''):
+    """
+    Return the path of the parquet cache file for `filename` in `cache_dir`.
+
+    The name is a digest of the absolute path, size and mtime of `filename`, so any
+    change to the file, including one that moves its mtime backwards, misses the cache.
+
+    Parameters:
+        filename (str): Path to the cached source file.
+        cache_dir (str): Directory holding the cached parquet files.
+        kind (str): Distinguishes caches holding different views of the same file.
+
+    Returns:
+        str: Path to the parquet file, which may not exist yet.
+    """
+    stat = os.stat(filename)
+    fingerprint = f"{kind}\0{os.path.abspath(filename)}\0{stat.st_size}\0{stat.st_mtime_ns}"
+    return os.path.join(cache_dir, hashlib.sha1(fingerprint.encode()).hexdigest() + '.parquet')
+
+def scan_cached_csv(filename, cache_dir):
+    """
+    Scan a sourmash CSV through a columnar parquet cache keyed by path, size and mtime.
+
+    On a miss the CSV is parsed once and its name and numeric columns written to
+    `cache_dir`; later runs scan the parquet file instead. Hits refresh the cache
+    file's mtime, which `evict_cache` uses as the last-used time.
+
+    Parameters:
+        filename (str): Path to the sourmash CSV file.
+        cache_dir (str): Directory holding the cached parquet files.
+
+    Returns:
+        pl.LazyFrame: A scan of the cached parquet file.
+    """
+    cached = cached_parquet_path(filename, cache_dir)
+
+    if os.path.exists(cached):
+        os.utime(cached)
+    else:
+        df = pl.read_csv(filename, separator=',', has_header=True)
+        keep = [col for col, dtype in df.schema.items() if col in CACHED_NAME_COLUMNS or dtype.is_numeric()]
+        tmp = f"{cached}.{os.getpid()}.{threading.get_ident()}.tmp"
+        df.select(keep).write_parquet(tmp)
+        os.replace(tmp, cached)
+
+    return pl.scan_parquet(cached)
+
+def evict_cache(cache_dir, max_bytes, keep=()):
+    """
+    Remove the least recently used parquet files until `cache_dir` fits in `max_bytes`.
+
+    Files in `keep` (the cache paths of the current run) are never removed, so the
+    lazy scans of this run stay valid even if they alone exceed the limit.
+
+    Returns:
+        int: Number of files removed.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.parquet'):
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+
+    keep = {os.path.abspath(path) for path in keep}
+    total = sum(size for _, size, _ in entries)
+    n_removed = 0
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if os.path.abspath(path) in keep:
+            continue
+        os.remove(path)
+        total -= size
+        n_removed += 1
+
+    return n_removed
+
+# the lineage columns of a sourmash taxonomy file, used by --all-ranks
+LINEAGE_RANKS = ('superkingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species', 'strain')
+
+def rank_output_path(output, rank):
+    """
+    Insert `rank` before the extension of `output`, e.g. 'gather.csv' -> 'gather.genus.csv'.
+    """
+    stem, ext = os.path.splitext(output)
+    return f"{stem}.{rank}{ext}"
+
+def load_taxonomy(taxonomy_file, ranks, cache_dir=None):
+    """
+    Load the 'ident' and `ranks` columns of a sourmash taxonomy file as a lookup table.
+
+    Rank columns are stored as categoricals, so the group_by after the join works on
+    integer codes. With `cache_dir` the parsed taxonomy is cached there as parquet,
+    keyed by the path, size and mtime of the CSV like the input cache.
+
+    Parameters:
+        taxonomy_file (str): Path to the sourmash taxonomy CSV.
+        ranks (list): The lineage rank columns to keep, or None for every
+                      column of `LINEAGE_RANKS` in the file (--all-ranks).
+        cache_dir (str): Optional directory for the parquet cache.
+
+    Returns:
+        pl.LazyFrame: A frame with 'ident' followed by the `ranks` columns.
+    """
+    cached = cached_parquet_path(taxonomy_file, cache_dir, kind='taxonomy') if cache_dir else None
+    if cached and os.path.exists(cached):
+        os.utime(cached)
+        taxdb = pl.scan_parquet(cached)
+    else:
+        taxdb = pl.read_csv(taxonomy_file)
+        taxdb = taxdb.with_columns(pl.col(pl.String).exclude('ident').cast(pl.Categorical))
+        if cached:
+            try:
+                tmp = f"{cached}.{os.getpid()}.tmp"
+                taxdb.write_parquet(tmp)
+                os.replace(tmp, cached)
+            except OSError as e:
+                print(f"Could not cache taxonomy to '{cached}' ({e}), continuing without it.")
+        taxdb = taxdb.lazy()
+
+    schema = taxdb.collect_schema()
+    if ranks is None:
+        ranks = [rank for rank in LINEAGE_RANKS if rank in schema]
+        if not ranks:
+            raise ValueError(f"No lineage rank columns ({', '.join(LINEAGE_RANKS)}) in taxonomy file: {taxonomy_file}")
+    missing = [col for col in ['ident'] + list(ranks) if col not in schema]
+    if missing:
+        raise ValueError(f"Missing columns {missing} in taxonomy file: {taxonomy_file}")
+
+    return taxdb.select(['ident'] + list(ranks))
+
+def join_taxonomy(df, taxdb, ranks):
+    """
+    Add a `match_name_{rank}` column to `df` for each of `ranks`.
+
+    The ident (the first word of `match_name`) is resolved once per distinct name rather
+    than once per row; the join back onto `df` is on the categorical name codes.
+    Matches missing from the taxonomy get nulls.
+
+    Parameters:
+        df (pl.LazyFrame): Long-format frame with `query_name`, `match_name` and values.
+        taxdb (pl.LazyFrame): The output of `load_taxonomy`.
+        ranks (list): The rank columns of `taxdb` to add.
+
+    Returns:
+        pl.LazyFrame: `df` with one `match_name_{rank}` column per rank.
+    """
+    names = (
+            df.select('match_name')
+            .unique(maintain_order=True)
+            .with_columns(pl.col('match_name').cast(pl.String).str.split(' ').list.get(0).alias('match_ident'))
+            .join(taxdb.select(['ident'] + list(ranks)), left_on='match_ident', right_on='ident', how='left', maintain_order='left')
+            .select(['match_name'] + [pl.col(rank).alias(f'match_name_{rank}') for rank in ranks])
+            )
+
+    return df.join(names, on='match_name', how='left', maintain_order='left')
+
+def aggregate_by_rank(df, lineage_rank, value_col, taxdb=None):
+    """
+    Sum `value_col` per `query_name` and taxonomic `lineage_rank` of each `match_name`.
+
+    Parameters:
+        df (pl.LazyFrame): Long-format frame with `query_name`, `match_name` and `value_col`.
+        lineage_rank (str): The rank to aggregate by.
+        value_col (str): The column holding the table values.
+        taxdb (pl.LazyFrame): The output of `load_taxonomy`; if None, `df` must already
+                              have been through `join_taxonomy` for this rank.
+
+    Returns:
+        pl.LazyFrame: A frame with `match_name_{lineage_rank}`, `query_name` and `value_col`,
+                      names still categorical (see `decode_names`).
+    """
+    rank_col = f'match_name_{lineage_rank}'
+    if taxdb is not None:
+        df = join_taxonomy(df, taxdb, [lineage_rank])
+
+    return (
+            df
+            .drop_nulls(rank_col)
+            .group_by([rank_col, 'query_name'], maintain_order=True)
+            .agg(pl.sum(value_col))
+            )
+
+def process_file(filename, column_selection, output_format="dense", lineage_rank='species', filter_rows=None, presence=False, taxdb=None, cache_dir=None):
     """
     Reads and processes any number of sourmash files to create a matrix of `match_name` values per `query_name`.
 
     Parameters:
         filename (str): Path to the sourmash file.
         output_format (str): Either "dense" or "sparse" to specify the output format.
+        cache_dir (str): Optional directory for a parquet cache of the parsed file.
 
     Returns:
         pl.DataFrame: 
@@ -366,57 +1748,18 @@ def process_file(filename, column_selection, output_format="dense", lineage_rank
         if os.path.getsize(filename) == 0:
             return None
 
-        df = pl.scan_csv(
-            filename,
-            separator=',',
-            has_header=True
-        )
-
-        schema = df.collect_schema()
-        if 'name' in schema:
-            df = df.rename({'name': 'match_name'})
-            schema = df.collect_schema()
-
-        # check for and select the columns of interest for the table
-        required_columns = [column_selection, 'query_name', 'match_name']
-        if not all(col in schema for col in required_columns):
-            raise ValueError(f"Missing required columns in file: {filename}")
-
-        df = df.select(required_columns)
-
-        if filter_rows:
-            df = df.filter(pl.col(column_selection) >= filter_rows)
-
-        if presence:
-            df = (
-                 df.with_columns(
-                     pl.when(pl.col(column_selection) > 0)
-                     .then(1)
-                     .otherwise(0)
-                     .alias(column_selection)
-                     )
-                 .rename({column_selection: f"{column_selection}_presence"})
-                 )
-
-        if taxdb is not None:
-            # find match_name that is in tax 
-            df = df.with_columns(
-                    pl.col('match_name').str.split(' ').list.get(0).alias('match_ident')
-                    )
-            merged_df = df.join(taxdb, left_on='match_ident', right_on='ident', how='left')
-            missing_df = merged_df.filter(pl.col(lineage_rank).is_null()).drop(['match_ident', lineage_rank])
+        if cache_dir and table_file_format(filename) == 'csv':
+            df = scan_cached_csv(filename, cache_dir)
+        else:
+            df = scan_table(filename)
 
-            required_columns.append(lineage_rank)
+        df = df.with_columns(pl.lit(filename).alias('source_file'))
+        df = long_frame(df, df.collect_schema().names(), filename, column_selection,
+                        filter_rows=filter_rows, presence=presence)
 
-            tax_df = (
-                     merged_df
-                     .select(required_columns)
-                     .rename({lineage_rank: f'match_name_{lineage_rank}'})
-                     .drop_nulls()
-                     .group_by([f'match_name_{lineage_rank}', 'query_name'])
-                     .agg(pl.sum(column_selection))
-                      )
-            df = tax_df
+        if taxdb is not None:
+            value_col = f"{column_selection}_presence" if presence else column_selection
+            df = aggregate_by_rank(df, lineage_rank, value_col, taxdb=taxdb)
 
         return df
 
@@ -427,40 +1770,358 @@ def process_file(filename, column_selection, output_format="dense", lineage_rank
         else:
             raise RuntimeError(f"Error processing file {filename}: {e}")
 
-def tables_main(args):
+def long_frame(df, columns, filename, column_selection, filter_rows=None, presence=False):
+    """
+    Project a scan of sourmash results to the long `query_name`, `match_name`, value table,
+    applying the --filter cutoff and --presence conversion in the same lazy plan.
+
+    Parameters:
+        df (pl.LazyFrame): A scan of one or more sourmash result files with a 'source_file' column.
+        columns (list): The columns of the scanned files.
+        filename (str): The (first) scanned file, for error messages.
+        column_selection (str): The numeric column that fills the table.
+
+    Returns:
+        pl.LazyFrame: The columns `column_selection` (or `<column>_presence`), query_name,
+                      match_name (both categorical) and source_file.
+    """
+    if 'name' in columns:
+        df = df.rename({'name': 'match_name'})
+        columns = ['match_name' if col == 'name' else col for col in columns]
+
+    # check for and select the columns of interest for the table
+    required_columns = [column_selection, 'query_name', 'match_name']
+    if not all(col in columns for col in required_columns):
+        raise ValueError(f"Missing required columns in file: {filename}")
+
+    df = df.select(required_columns + ['source_file'])
+
+    if filter_rows:
+        df = df.filter(pl.col(column_selection) >= filter_rows)
+
+    # intern the long names once; joins, group_bys and the pivot then compare integer codes.
+    # polars>=1.32 shares one categorical dictionary across scans, so no StringCache is needed
+    df = df.with_columns(pl.col('query_name', 'match_name').cast(pl.String).cast(pl.Categorical))
+
+    if presence:
+        df = (
+             df.with_columns(
+                 pl.when(pl.col(column_selection) > 0)
+                 .then(1)
+                 .otherwise(0)
+                 .alias(column_selection)
+                 )
+             .rename({column_selection: f"{column_selection}_presence"})
+             )
+
+    return df
+
+def probe_input(filename, column_selection, filter_rows=None, presence=False, cache_dir=None):
+    """
+    Decide how `scan_inputs` reads one input file.
+
+    Returns:
+        None for an empty file; ('csv' | 'parquet' | 'ipc', columns) for files that can share
+        one multi-file scan with neighbours of the same layout; or ('frame', pl.LazyFrame)
+        from `process_file` for gzipped and --cache-dir inputs, which are scanned on their own.
+    """
+    if os.path.getsize(filename) == 0:
+        return None
+
+    file_format = table_file_format(filename)
+    if file_format == 'csv' and not cache_dir and not filename.endswith('.gz'):
+        with open(filename, newline='') as fp:
+            header = next(csv.reader(fp), None)
+        return ('csv', tuple(header)) if header else None
+    elif file_format == 'parquet':
+        return ('parquet', tuple(pl.read_parquet_schema(filename)))
+    elif file_format == 'ipc':
+        return ('ipc', tuple(pl.read_ipc_schema(filename)))
+
+    return ('frame', process_file(filename, column_selection, filter_rows=filter_rows,
+                                  presence=presence, cache_dir=cache_dir))
+
+def scan_inputs(filenames, column_selection, filter_rows=None, presence=False, cache_dir=None, cores=None):
+    """
+    Build the lazy plans that read every input, scanning consecutive files that share a
+    format and header with a single multi-file `scan_csv`/`scan_parquet`/`scan_ipc`.
+
+    Only the header of each file is read up front (concurrently, in `cores` threads), so
+    there is no per-file schema inference; polars optimizes the filter, projection and
+    presence conversion once per scan. The source of every row is kept in 'source_file'.
+
+    Returns:
+        tuple: (lazy_frames, processed_files, skipped_files)
+    """
+    with ThreadPoolExecutor(max_workers=cores) as executor:
+        probes = list(executor.map(
+            partial(probe_input, column_selection=column_selection, filter_rows=filter_rows,
+                    presence=presence, cache_dir=cache_dir),
+            filenames))
+
+    runs = []
+    processed_files = []
+    skipped_files = []
+    for filename, probe in zip(filenames, probes):
+        if probe is None:
+            skipped_files.append(filename)
+            continue
+        processed_files.append(filename)
+        if probe[0] != 'frame' and runs and runs[-1][0] == probe:
+            runs[-1][1].append(filename)
+        else:
+            runs.append((probe, [filename]))
+
+    scanners = {'csv': pl.scan_csv, 'parquet': pl.scan_parquet, 'ipc': pl.scan_ipc}
+    lazy_frames = []
+    for (kind, detail), run in runs:
+        if kind == 'frame':
+            lazy_frames.append(detail)
+            continue
+        try:
+            df = scanners[kind](run, include_file_paths='source_file')
+            lazy_frames.append(long_frame(df, detail, run[0], column_selection,
+                                          filter_rows=filter_rows, presence=presence))
+        except Exception as e:
+            raise RuntimeError(f"Error processing file {run[0]}: {e}")
+
+    return lazy_frames, processed_files, skipped_files
+
+def decode_names(df):
+    """
+    Turn the categorical name columns of `df` back into strings, for output and merging.
+    """
+    return df.with_columns(pl.col(pl.Categorical).cast(pl.String))
+
+def duplicate_entry_error(index_col, row_name, query_name):
+    "Return the error raised when a (row, query) pair appears more than once in the long-format frame."
+    return ValueError(f"Found more than one value for {index_col} '{row_name}' in query '{query_name}'; "
+                      f"is the same query in more than one input file?")
+
+def check_unique_entries(long_df, index_col):
+    """
+    Raise a ValueError if any (`index_col`, `query_name`) pair of `long_df` appears more than once.
+
+    `DataFrame.pivot` would fail on such pairs; checking first gives the same error as
+    `code_long_frame`, so the dense, streaming and sparse paths all reject them.
+    """
+    duplicated = long_df.select(index_col, 'query_name').filter(pl.struct(index_col, 'query_name').is_duplicated())
+    if duplicated.height:
+        raise duplicate_entry_error(index_col, *duplicated.row(0))
+
+def code_long_frame(long_lf, index_col, value_col):
+    """
+    Collect the long-format frame as integer (row, column, value) codes, sorted by row.
+
+    Row and column codes follow the first appearance of each `index_col` and
+    `query_name` value, which is the order `DataFrame.pivot` uses. Like the pivot,
+    duplicate entries raise a ValueError. Everything runs on the polars streaming engine.
+
+    Returns:
+        tuple: (row_names, col_names, rows, cols, values), names as pl.Series and
+               codes/values as numpy arrays.
+    """
+    # first pass: assign integer codes to the row and column names
+    row_names = long_lf.select(pl.col(index_col).unique(maintain_order=True)).collect(engine='streaming').to_series()
+    col_names = long_lf.select(pl.col('query_name').unique(maintain_order=True)).collect(engine='streaming').to_series()
+    row_codes = pl.LazyFrame({index_col: row_names, '_row': pl.int_range(len(row_names), eager=True)})
+    col_codes = pl.LazyFrame({'query_name': col_names, '_col': pl.int_range(len(col_names), eager=True)})
+
+    coded = (
+            long_lf
+            .join(row_codes, on=index_col)
+            .join(col_codes, on='query_name')
+            .group_by(['_row', '_col'])
+            .agg(pl.col(value_col).first(), pl.len().alias('_n'))
+            .sort('_row')
+            .collect(engine='streaming')
+            )
+    duplicated = coded.filter(pl.col('_n') > 1)
+    if duplicated.height:
+        row, col = duplicated.row(0)[:2]
+        raise duplicate_entry_error(index_col, row_names[row], col_names[col])
+    return (row_names.cast(pl.String), col_names.cast(pl.String),
+            coded['_row'].to_numpy(), coded['_col'].to_numpy(), coded[value_col].to_numpy())
+
+def sparse_label_paths(output):
+    """
+    Return the row and column label files of a sparse matrix export, e.g.
+    'table.mtx' -> ('table.rows.txt', 'table.cols.txt').
+    """
+    stem = os.path.splitext(output)[0]
+    return f"{stem}.rows.txt", f"{stem}.cols.txt"
+
+def write_sparse_matrix(rows, cols, values, row_names, col_names, output, matrix_format, chunk_size=1_000_000):
+    """
+    Write a sparse matrix given as COO triplets, plus its row and column labels.
+
+    'mtx' writes a Matrix Market coordinate file (R: `Matrix::readMM`), 'npz' a CSR
+    matrix in the layout of `scipy.sparse.save_npz`. Labels are written one per line,
+    in matrix order, to the files named by `sparse_label_paths`.
+
+    Parameters:
+        rows, cols (np.ndarray): Zero-based row and column index of each entry.
+        values (np.ndarray): The value of each entry.
+        row_names, col_names (iterable): The row and column labels.
+        output (str): Path of the matrix file.
+        matrix_format (str): 'mtx' or 'npz'.
+
+    Returns:
+        tuple: (n_rows, n_cols, n_entries) of the written matrix.
+    """
+    row_names, col_names = list(row_names), list(col_names)
+    n_rows, n_cols = len(row_names), len(col_names)
+    rows, cols, values = np.asarray(rows), np.asarray(cols), np.asarray(values)
+    order = np.lexsort((cols, rows))
+    rows, cols, values = rows[order], cols[order], values[order]
+
+    if matrix_format == 'mtx':
+        field = 'integer' if np.issubdtype(values.dtype, np.integer) else 'real'
+        with open(output, 'wb') as fp:
+            fp.write(f"%%MatrixMarket matrix coordinate {field} general\n{n_rows} {n_cols} {len(values)}\n".encode())
+            for start in range(0, len(values), chunk_size):
+                stop = start + chunk_size
+                entries = pl.DataFrame({'row': rows[start:stop] + 1, 'col': cols[start:stop] + 1, 'value': values[start:stop]})
+                buf = io.BytesIO()
+                entries.write_csv(buf, separator=' ', include_header=False)
+                fp.write(buf.getvalue())
+    elif matrix_format == 'npz':
+        indptr = np.zeros(n_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+        index_dtype = np.int32 if max(n_cols, len(values)) < 2**31 else np.int64
+        with open(output, 'wb') as fp:
+            np.savez_compressed(fp, data=values, indices=cols.astype(index_dtype),
+                                indptr=indptr.astype(index_dtype), format=np.array(b'csr'),
+                                shape=np.array([n_rows, n_cols]))
+    else:
+        raise ValueError(f"Unknown sparse matrix format: {matrix_format}")
+
+    for path, names in zip(sparse_label_paths(output), (row_names, col_names)):
+        with open(path, 'wt', encoding='utf-8') as fp:
+            fp.writelines(f"{name}\n" for name in names)
+
+    return n_rows, n_cols, len(values)
+
+def write_dense_streaming(long_lf, index_col, value_col, output, chunk_rows=10_000, compress=False, cores=None,
+                          stats=None):
+    """
+    Write the dense `match_name` x `query_name` matrix without materializing it.
+
+    The long-format frame is collected with the polars streaming engine as integer
+    (row, column, value) codes; the matrix is then filled and written `chunk_rows`
+    rows at a time, so peak memory is bounded by the chunk rather than the matrix.
+    Row and column order match `DataFrame.pivot`; duplicate entries raise a ValueError.
+
+    Parameters:
+        long_lf (pl.LazyFrame): Long-format output of `process_file`, concatenated.
+        index_col (str): The column holding the row names, e.g. 'match_name'.
+        value_col (str): The column holding the table values.
+        output (str): Path to write the CSV file to.
+        chunk_rows (int): Number of matrix rows to hold in memory at once.
+        compress (bool): gzip the output, compressing chunks in parallel with `write_gzip_members`.
+        cores (int): Number of compression threads.
+        stats (TableStats): Optional column statistics, updated with every written chunk.
+
+    Returns:
+        tuple: (n_rows, n_cols) of the written matrix, excluding the index column.
+    """
+    row_names, col_names, rows, cols, values = code_long_frame(long_lf, index_col, value_col)
+
+    def chunk_frames():
+        for start in range(0, max(len(row_names), 1), chunk_rows):
+            stop = min(start + chunk_rows, len(row_names))
+            lo, hi = np.searchsorted(rows, [start, stop])
+
+            block = np.zeros((len(col_names), stop - start), dtype=values.dtype)
+            block[cols[lo:hi], rows[lo:hi] - start] = values[lo:hi]
+
+            chunk_df = pl.DataFrame(
+                    [row_names[start:stop]] +
+                    [pl.Series(name, block[j]) for j, name in enumerate(col_names)]
+                    )
+            yield chunk_df if stats is None else stats.update(chunk_df)
+
+    if compress:
+        write_gzip_members(chunk_frames(), output, cores=cores)
+    else:
+        with open(output, 'wb') as fp:
+            for n, chunk_df in enumerate(chunk_frames()):
+                buf = io.BytesIO()
+                chunk_df.write_csv(buf, include_header=(n == 0))
+                fp.write(buf.getvalue())
+
+    return len(row_names), len(col_names)
+
+def tables_main(args, profiler=None):
 
     args
 
+    profiler = profiler or StageProfiler()
+    value_col = f"{args.column}_presence" if args.presence else args.column
+    ranks = [rank.strip() for rank in args.lineage_rank.split(',') if rank.strip()]
+    args.output_format = resolve_output_format(args.output, args.output_format, args.gzip)
+
+    if args.all_ranks and not args.taxonomy_file:
+        raise ValueError("--all-ranks requires a taxonomy file ('-t').")
+
+    if args.cache_dir:
+        os.makedirs(args.cache_dir, exist_ok=True)
+
     if args.taxonomy_file:
         print(f"Loading taxonomy file...")
-        taxdb_lazy = pl.read_csv(args.taxonomy_file).lazy()     
-        print(f"    Found {len(taxdb_lazy)} identifiers in taxonomy file.")
-    else: 
+        profiler.start('load_taxonomy')
+        taxdb_lazy = load_taxonomy(args.taxonomy_file, None if args.all_ranks else ranks, cache_dir=args.cache_dir)
+        if args.all_ranks:
+            ranks = taxdb_lazy.collect_schema().names()[1:]
+        n_idents = taxdb_lazy.select(pl.len()).collect().item()
+        profiler.stop(rows_out=n_idents, columns_out=len(ranks) + 1)
+        print(f"    Found {n_idents} identifiers in taxonomy file.")
+    else:
         taxdb_lazy = None
 
-
-    total_files = len(args.filenames)
+    filenames = args.filenames
+    if args.append_to:
+        if args.collapse_columns or args.extract_columns or args.streaming or len(ranks) > 1 \
+                or args.format in SPARSE_MATRIX_FORMATS:
+            raise ValueError("--append-to only supports single dense or sparse tables, without --collapse-columns, "
+                             "--extract-columns, --streaming or several lineage ranks.")
+
+        manifest = read_table_manifest(table_manifest_path(args.append_to))
+        fingerprints = {}
+        filenames = []
+        replaced_queries = set()
+        for filename in args.filenames:
+            stat = os.stat(filename)
+            path = os.path.abspath(filename)
+            fingerprints[filename] = (stat.st_size, stat.st_mtime_ns)
+            if path in manifest:
+                if manifest[path][:2] == fingerprints[filename]:
+                    continue
+                replaced_queries.update(manifest[path][2])
+            filenames.append(filename)
+        print(f"{len(args.filenames) - len(filenames)} file(s) already in '{args.append_to}', "
+              f"adding {len(filenames)} new or changed file(s).")
+
+    total_files = len(filenames)
     print(f"Starting parallel processing of {total_files} file(s)...")
 
-    lazy_frames = []
-    skipped_files = []
-
-    for file in args.filenames:
-        result = process_file(
-            filename=file,
-            column_selection=args.column,
-            presence=args.presence,
-            output_format=args.format,
-            lineage_rank=args.lineage_rank,
-            filter_rows=args.filter,
-            taxdb=taxdb_lazy
-        )
-        if result is not None:
-            lazy_frames.append(result)
-        else:
-            skipped_files.append(file)
-
-    print(f"Successfully processed {len(lazy_frames)} file(s).")
+    # one lazy plan over all inputs; headers are probed concurrently and in input order,
+    # keeping skips and the first error deterministic
+    profiler.start('scan_inputs')
+    lazy_frames, processed_files, skipped_files = scan_inputs(
+            filenames, args.column, filter_rows=args.filter, presence=args.presence,
+            cache_dir=args.cache_dir, cores=args.cores)
+    profiler.stop(files_in=len(filenames), files_out=len(processed_files), scans=len(lazy_frames))
+
+    print(f"Successfully processed {len(processed_files)} file(s).")
+    if args.cache_dir:
+        # the lazy frames still scan this run's cache files, so those are never evicted
+        in_use = [cached_parquet_path(filename, args.cache_dir)
+                  for filename in processed_files if table_file_format(filename) == 'csv']
+        if args.taxonomy_file:
+            in_use.append(cached_parquet_path(args.taxonomy_file, args.cache_dir, kind='taxonomy'))
+        n_evicted = evict_cache(args.cache_dir, args.cache_max_size * 1024**3, keep=in_use)
+        if n_evicted: print(f"Evicted {n_evicted} file(s) from the cache in '{args.cache_dir}'.")
     if len(skipped_files) == 0:
         print(f"Nothing to skip. Moving on...")
     else:
@@ -468,93 +2129,284 @@ def tables_main(args):
         with open("skipped-files.txt", "wt") as fp:
             print(f"{skipped_files}", file=fp)
 
-    if args.verbose: print("Listing each individual dataframe...\n", dfs, '\nList of DataFrames completed.')
+    if args.verbose: print("Listing each individual dataframe...\n", lazy_frames, '\nList of DataFrames completed.')
+
+    if args.append_to:
+        append_main(args, lazy_frames, processed_files, skipped_files, fingerprints, manifest, replaced_queries, ranks,
+                    value_col, taxdb_lazy, profiler=profiler)
+        return
+
+    long_lf = pl.concat(lazy_frames).drop('source_file')
+    if taxdb_lazy is None:
+        write_table(long_lf, args, "match_name", args.output, profiler=profiler)
+    elif len(ranks) == 1:
+        # resolve idents once for all inputs, not once per file
+        long_lf = aggregate_by_rank(long_lf, ranks[0], value_col, taxdb=taxdb_lazy)
+        write_table(long_lf, args, f"match_name_{ranks[0]}", args.output, profiler=profiler)
+    else:
+        # scan and join once, then build every rank's table from the same frame
+        print(f"Joining taxonomy for ranks: {', '.join(ranks)}")
+        joined_lf = join_taxonomy(long_lf, taxdb_lazy, ranks)
+        if args.explain: print(f"Optimized query plan for the taxonomy join:\n{joined_lf.explain()}")
+        profiler.plan('taxonomy join', joined_lf)
+        profiler.start('taxonomy_join')
+        joined_df = joined_lf.collect()
+        profiler.stop(rows_out=joined_df.height, columns_out=joined_df.width)
+        joined_lf = joined_df.lazy()
+        for rank in ranks:
+            output = rank_output_path(args.output, rank)
+            print(f"\nBuilding {rank} table '{output}'...")
+            rank_lf = aggregate_by_rank(joined_lf, rank, value_col)
+            write_table(rank_lf, args, f"match_name_{rank}", output, profiler=profiler)
+
+def append_main(args, lazy_frames, processed_files, skipped_files, fingerprints, manifest, replaced_queries, ranks,
+                value_col, taxdb_lazy, profiler=None):
+    """
+    The --append-to part of `tables_main`: merge the new or changed inputs into the
+    existing table, write it to `args.output` and record every input in its manifest.
+    """
+    profiler = profiler or StageProfiler()
+    index_col = f"match_name_{ranks[0]}" if taxdb_lazy is not None else "match_name"
+    output_format = args.output_format
+    output = args.output
+    if output_format == 'csv.gz' and not output.endswith('.gz'):
+        output = output + '.gz'
+
+    existing_df = None
+    if os.path.exists(args.append_to):
+        print(f"Loading existing table '{args.append_to}'...")
+        profiler.start('load_existing')
+        existing_df = scan_table(args.append_to).collect()
+        profiler.stop(rows_out=existing_df.height, columns_out=existing_df.width)
+    else:
+        print(f"'{args.append_to}' does not exist yet, building it from scratch.")
+
+    # record which queries each input contributed, so a changed input can be replaced later
+    if lazy_frames:
+        query_lists = (
+                pl.concat([lf.select('source_file', 'query_name') for lf in lazy_frames])
+                .group_by('source_file', maintain_order=True)
+                .agg(pl.col('query_name').unique(maintain_order=True))
+                .collect()
+                )
+        queries_by_file = dict(zip(query_lists['source_file'], query_lists['query_name'].to_list()))
+        for filename in processed_files:
+            manifest[os.path.abspath(filename)] = fingerprints[filename] + (queries_by_file.get(filename, []),)
+    # skipped inputs contribute no queries; record them so an unchanged rerun does not retry them
+    for filename in skipped_files:
+        manifest[os.path.abspath(filename)] = fingerprints[filename] + ([],)
+
+    if lazy_frames:
+        long_lf = pl.concat(lazy_frames).drop('source_file')
+        if taxdb_lazy is not None:
+            long_lf = aggregate_by_rank(long_lf, ranks[0], value_col, taxdb=taxdb_lazy)
+        write_table(long_lf, args, index_col, args.output, existing_df, replaced_queries, profiler=profiler)
+    elif existing_df is not None and replaced_queries:
+        # the changed inputs are now empty or skipped, so their old queries go, as in a rebuild
+        print(f"Dropping {len(replaced_queries)} queries of changed inputs that are now empty or skipped.")
+        existing_df = drop_queries(existing_df, index_col, args.format, replaced_queries)
+        write_frame(existing_df, output, output_format, cores=args.cores)
+    elif existing_df is not None:
+        print("Nothing new to add.")
+        if os.path.abspath(args.append_to) != os.path.abspath(output):
+            write_frame(existing_df, output, output_format, cores=args.cores)
+    else:
+        raise ValueError("No inputs to build a table from.")
+
+    write_table_manifest(table_manifest_path(output), manifest)
+    print(f"Recorded {len(manifest)} input(s) in '{table_manifest_path(output)}'.")
+
+def table_manifest_path(table):
+    """
+    Return the manifest recording the inputs of an --append-to table, e.g. 'gather.csv.manifest.csv'.
+    """
+    return table + '.manifest.csv'
+
+def read_table_manifest(path):
+    """
+    Read an --append-to manifest.
+
+    Returns:
+        dict: absolute input path -> (size, mtime_ns, [query names])
+    """
+    if not os.path.exists(path):
+        return {}
+
+    manifest = {}
+    for row in pl.read_csv(path, schema_overrides={'query_names': pl.String}).iter_rows(named=True):
+        queries = row['query_names'].split(';') if row['query_names'] else []
+        manifest[row['filename']] = (row['size'], row['mtime_ns'], queries)
+    return manifest
+
+def write_table_manifest(path, manifest):
+    """
+    Write an --append-to manifest as CSV: filename, size, mtime_ns and ';'-joined query names.
+    """
+    pl.DataFrame(
+            [(filename, size, mtime_ns, ';'.join(queries))
+             for filename, (size, mtime_ns, queries) in manifest.items()],
+            schema={'filename': pl.String, 'size': pl.Int64, 'mtime_ns': pl.Int64, 'query_names': pl.String},
+            orient='row'
+            ).write_csv(path)
+
+def drop_queries(existing_df, index_col, table_format, queries):
+    """
+    Drop the columns (dense) or rows (sparse) of `queries` from a previously written table.
+
+    Dense rows that only the dropped columns had values for are removed too, as they
+    would not be in a rebuilt table.
+
+    Returns:
+        pl.DataFrame: The table without `queries`.
+    """
+    queries = set(queries)
+    if table_format == 'sparse':
+        return existing_df.filter(~pl.col('query_name').is_in(list(queries)))
+
+    dropped = [col for col in existing_df.columns[1:] if col in queries]
+    if dropped:
+        existing_df = existing_df.drop(dropped)
+        if len(existing_df.columns) > 1:
+            existing_df = existing_df.filter(pl.any_horizontal(pl.exclude(index_col) != 0))
+    return existing_df
+
+def merge_into_table(existing_df, new_df, index_col, table_format, replaced_queries=()):
+    """
+    Merge newly built table contents into a previously written table.
+
+    Columns (dense) or rows (sparse) of `replaced_queries`, and of every query present in
+    `new_df`, are dropped from `existing_df` before the new ones are added. Dense tables
+    keep the existing row and column order, with new rows and columns appended.
+
+    Returns:
+        pl.DataFrame: The merged table.
+    """
+    replaced_queries = set(replaced_queries)
+    if table_format == 'sparse':
+        replaced_queries.update(new_df['query_name'].unique().to_list())
+        existing_df = drop_queries(existing_df, index_col, table_format, replaced_queries)
+        return pl.concat([existing_df, new_df], how='vertical_relaxed')
+
+    replaced_queries.update(col for col in new_df.columns if col != index_col)
+    existing_df = drop_queries(existing_df, index_col, table_format, replaced_queries)
+    merged = existing_df.join(new_df, on=index_col, how='full', coalesce=True, maintain_order='left_right')
+    return merged.with_columns(pl.exclude(index_col).fill_null(0))
+
+def write_table(long_lf, args, index_col, output, existing_df=None, replaced_queries=(), profiler=None):
+    """
+    Build the dense or sparse table from the long-format frame and write it to `output`.
+
+    Parameters:
+        long_lf (pl.LazyFrame): Long-format frame from `process_file`/`aggregate_by_rank`.
+        args: The parsed gather_tables/prefetch_tables arguments.
+        index_col (str): The column holding the row names of the table.
+        output (str): Path to write the table to ('.gz' is appended for csv.gz output).
+        existing_df (pl.DataFrame): With --append-to, the previous table to merge into.
+        replaced_queries (iterable): With --append-to, queries of changed inputs to drop from `existing_df`.
+        profiler (StageProfiler): Records each stage for --profile-json.
+    """
+    profiler = profiler or StageProfiler()
+    output_format = args.output_format
+    if output_format == 'csv.gz' and not output.endswith('.gz'):
+        output = output + '.gz'
+
+    if args.explain: print(f"Optimized query plan for '{output}':\n{long_lf.explain()}")
+    profiler.plan(output, long_lf)
+
+    if args.format in SPARSE_MATRIX_FORMATS:
+        if args.collapse_columns or args.extract_columns:
+            raise ValueError(f"--format {args.format} cannot be combined with --collapse-columns or --extract-columns.")
+
+        value_col = f"{args.column}_presence" if args.presence else args.column
+        profiler.start('sparse_matrix')
+        row_names, col_names, rows, cols, values = code_long_frame(long_lf, index_col, value_col)
+        n_rows, n_cols, n_entries = write_sparse_matrix(rows, cols, values, row_names, col_names,
+                                                        output, args.format)
+        profiler.stop(table=output, rows_out=n_rows, columns_out=n_cols, entries=n_entries)
+        print(f"Wrote a {n_rows} x {n_cols} sparse matrix with {n_entries} entries to {output}")
+        print(f"Row and column labels are in {' and '.join(sparse_label_paths(output))}")
+        return
+
+    if args.streaming and args.format == "dense":
+        if args.collapse_columns or args.extract_columns:
+            raise ValueError("--streaming cannot be combined with --collapse-columns or --extract-columns.")
+        if output_format not in ('csv', 'csv.gz'):
+            raise ValueError("--streaming only writes csv or csv.gz output.")
+
+        value_col = f"{args.column}_presence" if args.presence else args.column
+        print(f'writing dense format in chunks of {args.chunk_size} rows...')
+        profiler.start('write_streaming')
+        stats = TableStats(index_col) if args.report != 'full' else None
+        n_rows, n_cols = write_dense_streaming(long_lf, index_col, value_col, output,
+                                               chunk_rows=args.chunk_size, compress=(output_format == 'csv.gz'),
+                                               cores=args.cores, stats=stats)
+        profiler.stop(table=output, rows_out=n_rows, columns_out=n_cols)
+        if stats is None:
+            print(f"Wrote a {n_rows} x {n_cols} table to {output}")
+        else:
+            print_table_summary(output, n_rows, n_cols + 1, stats)
+            print_viewing_hint(output, output_format, stats.names_with_commas)
+        return
 
     # Combine all DataFrames
     if args.format == "dense":
         # Outer join to create a dense matrix with all 'name' columns
         # https://docs.pola.rs/api/python/dev/reference/api/polars.concat.html#polars.concat
         print('attempting dense format...')
-        combined_df = pl.concat(lazy_frames).collect().pivot(
-                values = f"{args.column}_presence" if args.presence else args.column,
-                index = f"match_name_{args.lineage_rank}" if taxdb_lazy is not None and f"match_name_{args.lineage_rank}" in df.columns else "match_name",
-                columns = "query_name",
-            ).fill_null(0)
-
-        if args.collapse_columns and args.presence and not args.extract_columns:
-            print(f"Processing the following files: {args.collapse_columns}")
-            collapse_df = combined_df[:, [0]]
-
-            for fp in args.collapse_columns:
-                print(f"Processing: {fp}")
-                h, i = read_file_and_separate(fp)
-                if args.verbose: print(f"First line: {h}")
-                if args.verbose: print(f"Remaining lines: {i}")
-
-                existing_columns = [col for col in i if col in combined_df.columns]
-                if args.verbose: print(exsting_columns)
-
-                if existing_columns:
-                    new_column = (
-                            combined_df.select(
-                                sum(pl.col(col) for col in existing_columns).alias(f"{h}")
-                                ).to_series()
-                            )
-                    collapse_df = collapse_df.with_columns(new_column)
-                    print(f"... Updating DataFrame with {h}")
-                    if args.verbose: print(collapse_df)
-                else:
-                    print(f"No matching columns found for {fp}, skipping...")
-
-            if args.verbose: print("Final collapsed DataFrame:\n", collapse_df)
-            combined_df = collapse_df
+        value_col = f"{args.column}_presence" if args.presence else args.column
 
+        extract_groups = None
         if args.extract_columns and not args.collapse_columns:
             print(f"Processing the following files: {args.extract_columns}")
-            extract_df = combined_df[:, [0]]  # keep first column as key/index
-        
-            for fp in args.extract_columns:
-                print(f"Processing: {fp}")
-                h, i = read_file_and_separate(fp)
-                if args.verbose: print(f"First line: {h}")
-                if args.verbose: print(f"Remaining lines: {i}")
-        
-                existing_columns = [col for col in i if col in combined_df.columns]
-                if args.verbose: print(existing_columns)
-        
-                if existing_columns:
-                    # Select only the existing columns and optionally rename them
-                    new_columns = combined_df.select(existing_columns)
-                    extract_df = extract_df.with_columns(new_columns)
-                    print(f"... Updating DataFrame with columns from {h}")
-                    if args.verbose: print(extract_df)
-                else:
-                    print(f"No matching columns found for {fp}, skipping...")
-
-            if args.verbose: print("Final extracted DataFrame:\n", extract_df)
-            combined_df = extract_df
-
-            numeric_types = {
-                pl.Int8, pl.Int16, pl.Int32, pl.Int64,
-                pl.UInt8, pl.UInt16, pl.UInt32, pl.UInt64,
-                pl.Float32, pl.Float64
-            }
-            def get_numeric_columns(df: pl.DataFrame) -> pl.DataFrame:
-                numeric_cols = [col for col, dtype in zip(df.columns, df.dtypes) if dtype in numeric_types]
-                return df.select(numeric_cols)
-
-            numeric_df = get_numeric_columns(extract_df)
-            
-            # Filter out rows where all numeric values are zero
-            extract_df = extract_df.filter(
-                pl.any_horizontal(numeric_df.cast(pl.Float64) != 0)
-            )
-
+            extract_groups = read_column_groups(args.extract_columns)
+            extract_names = list(dict.fromkeys(col for header, members, path in extract_groups for col in members))
+            # only the requested samples' non-zero values reach the pivot, so all-zero rows never exist
+            long_lf = long_lf.filter(pl.col('query_name').is_in(extract_names) & (pl.col(value_col) != 0))
+
+        # scanning, filtering and the taxonomy join all run when the long frame is collected
+        profiler.start('collect')
+        long_df = long_lf.collect()
+        profiler.stop(table=output, rows_out=long_df.height, columns_out=long_df.width)
+
+        profiler.start('pivot')
+        check_unique_entries(long_df, index_col)
+        combined_df = decode_names(long_df.pivot(
+                values = value_col,
+                index = index_col,
+                columns = "query_name",
+            ).fill_null(0))
+        del long_df
+        profiler.stop(table=output, rows_out=combined_df.height, columns_out=combined_df.width)
 
+        if existing_df is not None:
+            profiler.start('merge')
+            combined_df = merge_into_table(existing_df, combined_df, index_col, args.format, replaced_queries)
+            profiler.stop(table=output, rows_out=combined_df.height, columns_out=combined_df.width)
 
-        print(combined_df)
+        if args.collapse_columns and args.presence and not args.extract_columns:
+            print(f"Processing the following files: {args.collapse_columns}")
+            profiler.start('collapse')
+            sample_df = combined_df.drop(index_col)
+            group_names, group_sums = collapse_column_groups(sample_df.to_numpy(), sample_df.columns,
+                                                             read_column_groups(args.collapse_columns),
+                                                             verbose=args.verbose)
+            combined_df = combined_df.select(index_col).with_columns([
+                pl.Series(name, group_sums[:, j]) for j, name in enumerate(group_names)
+            ])
+            profiler.stop(table=output, columns_in=sample_df.width, rows_out=combined_df.height, columns_out=combined_df.width)
+            if args.verbose: print("Final collapsed DataFrame:\n", combined_df)
+
+        if extract_groups is not None:
+            profiler.start('extract')
+            combined_df = extract_column_groups(combined_df, index_col, extract_groups, verbose=args.verbose)
+            profiler.stop(table=output, rows_out=combined_df.height, columns_out=combined_df.width)
+            if args.verbose: print("Final extracted DataFrame:\n", combined_df)
+
+        # full-table previews and scans only for small tables or with --report full
+        full = full_report(args, combined_df)
+        if full: print(combined_df)
         # Create a list of data and numeric columns
-        #data_cols = [col for col in combined_df.columns if col not in {'match_name', f'match_name_{args.lineage_rank}'}]
+        #data_cols = [col for col in combined_df.columns if col not in {'match_name', index_col}]
         numeric_cols = combined_df.select(
             pl.col([
                 pl.Decimal,
@@ -589,44 +2441,451 @@ def tables_main(args):
 
     else:  # Sparse format
         # Concatenate DataFrames without merging on 'name' to maintain sparse format
-        combined_df = pl.concat(lazy_frames).collect()
-    
+        profiler.start('collect')
+        combined_df = decode_names(long_lf.collect())
+        profiler.stop(table=output, rows_out=combined_df.height, columns_out=combined_df.width)
+
+        if existing_df is not None:
+            profiler.start('merge')
+            combined_df = merge_into_table(existing_df, combined_df, index_col, args.format, replaced_queries)
+            profiler.stop(table=output, rows_out=combined_df.height, columns_out=combined_df.width)
+
         # Optionally sort by the percentage column ('percent' or similar)
         if 'f_unique_weighted' in combined_df.columns:
             combined_df = combined_df.sort('f_unique_weighted', descending=True)
+        full = full_report(args, combined_df)
 
-    # What should be the final output upon completion?
-    print(combined_df)
+    if full:
+        # What should be the final output upon completion?
+        print(combined_df)
 
-#    print(combined_df.shape)
-#    print(combined_df.schema)
-    #print(combined_df.describe())
-    print(combined_df.sample(fraction=0.01))
+#        print(combined_df.shape)
+#        print(combined_df.schema)
+        #print(combined_df.describe())
+        print(combined_df.sample(fraction=0.01))
 
-    if args.gzip:
-        output = args.output + '.gz'
+    # the summary statistics are gathered from the chunks as they are written
+    stats = None if full else TableStats(index_col)
+    profiler.start('write')
+    write_frame(combined_df, output, output_format, cores=args.cores, stats=stats)
+    profiler.stop(table=output, rows_in=combined_df.height, columns_in=combined_df.width)
 
-        with gzip.open(output, 'wt', encoding='UTF-8') as fp:
-            combined_df.write_csv(fp)
+    if not full:
+        print_table_summary(output, combined_df.height, combined_df.width, stats)
+        print_viewing_hint(output, output_format, stats.names_with_commas)
 
+    elif output_format == 'csv.gz':
         # Print something to help look at the output in the terminal
-        if combined_df["match_name"].str.contains(",").any() or combined_df[f"match_name_{args.lineage_rank}"].str.contains(",").any():
+        if combined_df[index_col].str.contains(",").any():
             print(f"""\n\nConsider running `gzip -cd {output} | sed -E 's/"([^"]*),([^"]*)"/"\\1|\\2"/g' | column -s, -t | less -S` to see the full table.\n""")
         else:
             print(f"\n\nConsider running `gzip -cd {output} | column -s, -t | less -S` to see full table.\n")
 
-    else:
-        combined_df.write_csv(args.output)
-
+    elif output_format == 'csv':
         if "match_name" in combined_df.columns:
             if combined_df["match_name"].str.contains(",").any():
-                print(f"""\n\nConsider running `sed -E 's/"([^"]*),([^"]*)"/"\\1|\\2"/g' {args.output} | column -s, -t | less -S` to see the full table.\n""")
+                print(f"""\n\nConsider running `sed -E 's/"([^"]*),([^"]*)"/"\\1|\\2"/g' {output} | column -s, -t | less -S` to see the full table.\n""")
             else:
-                print(f"\n\nConsider running `cat {args.output} | column -s, -t | less -S` to see full table.\n")
+                print(f"\n\nConsider running `cat {output} | column -s, -t | less -S` to see full table.\n")
 
-        elif f"match_name_{args.lineage_rank}" in combined_df.columns:
-            if combined_df[f"match_name_{args.lineage_rank}"].str.contains(",").any():
-                print(f"""\n\nConsider running `sed -E 's/"([^"]*),([^"]*)"/"\\1|\\2"/g' {args.output} | column -s, -t | less -S` to see the full table.\n""")
+        elif index_col in combined_df.columns:
+            if combined_df[index_col].str.contains(",").any():
+                print(f"""\n\nConsider running `sed -E 's/"([^"]*),([^"]*)"/"\\1|\\2"/g' {output} | column -s, -t | less -S` to see the full table.\n""")
             else:
-                print(f"\n\nConsider running `cat {args.output} | column -s, -t | less -S` to see full table.\n")
+                print(f"\n\nConsider running `cat {output} | column -s, -t | less -S` to see full table.\n")
+
+# tables up to this many cells get the full terminal report with --report auto
+REPORT_FULL_CELLS = 1_000_000
+
+def full_report(args, df):
+    """
+    Whether to print full-table previews and viewing hints for `df`: always with
+    --report full, never with --report summary, and for small tables with --report auto.
+    """
+    if args.report == 'auto':
+        return df.height * df.width <= REPORT_FULL_CELLS
+    return args.report == 'full'
+
+class TableStats:
+    """
+    Per-column statistics of a table, accumulated chunk by chunk while it is written.
+
+    Every numeric column other than `index_col` gets its non-zero count, sum, min and
+    max, each chunk costing a single `select`. Whether any row or column name contains
+    a comma (and so is quoted in the CSV) is recorded along the way.
+    """
+    def __init__(self, index_col):
+        self.index_col = index_col
+        self.columns = None
+        self.nonzero = self.sums = self.mins = self.maxs = None
+        self.integer = True
+        self.names_with_commas = False
+
+    def update(self, df):
+        """
+        Add the rows of `df` to the statistics and return `df`, so it can wrap a chunk generator.
+        """
+        if self.columns is None:
+            self.columns = [col for col, dtype in df.schema.items()
+                            if col != self.index_col and dtype.is_numeric()]
+            self.integer = all(df.schema[col].is_integer() for col in self.columns)
+            n_cols = len(self.columns)
+            self.nonzero = np.zeros(n_cols, dtype=np.int64)
+            self.sums = np.zeros(n_cols)
+            self.mins = np.full(n_cols, np.inf)
+            self.maxs = np.full(n_cols, -np.inf)
+            self.names_with_commas = any(',' in col for col in df.columns)
+
+        if df.height and self.columns:
+            cols = pl.col(self.columns).cast(pl.Float64)
+            values = np.array(df.select(
+                (cols != 0).cast(pl.Float64).sum().name.suffix('\tnonzero'),
+                cols.sum().name.suffix('\tsum'),
+                cols.min().name.suffix('\tmin'),
+                cols.max().name.suffix('\tmax'),
+            ).row(0), dtype=np.float64).reshape(4, -1)
+            self.nonzero += values[0].astype(np.int64)
+            self.sums += values[1]
+            np.minimum(self.mins, values[2], out=self.mins)
+            np.maximum(self.maxs, values[3], out=self.maxs)
+
+        if not self.names_with_commas and df.height and df.schema.get(self.index_col) in (pl.String, pl.Categorical):
+            self.names_with_commas = bool(df[self.index_col].cast(pl.String).str.contains(',', literal=True).any())
+        return df
 
+    def to_frame(self):
+        """
+        Return the statistics as a frame with one row per column.
+        """
+        columns = self.columns or []
+        value_dtype = pl.Int64 if self.integer else pl.Float64
+        return pl.DataFrame({
+            'column': columns,
+            'nonzero': self.nonzero if columns else [],
+            'sum': pl.Series(self.sums if columns else [], dtype=pl.Float64).cast(value_dtype),
+            'min': pl.Series(self.mins if columns else [], dtype=pl.Float64).cast(value_dtype),
+            'max': pl.Series(self.maxs if columns else [], dtype=pl.Float64).cast(value_dtype),
+        }, schema_overrides={'column': pl.String, 'nonzero': pl.Int64})
+
+def print_table_summary(output, n_rows, n_cols, stats=None):
+    """
+    Report the shape and on-disk size of a written table and, if given, the
+    per-column statistics gathered by a `TableStats` while it was written.
+    """
+    size = os.path.getsize(output) if os.path.exists(output) else 0
+    print(f"Wrote a {n_rows} x {n_cols} table ({size / 1024**2:.1f} MB) to {output}")
+    if stats is None or not stats.columns:
+        return
+
+    n_cells = n_rows * len(stats.columns)
+    n_nonzero = int(stats.nonzero.sum())
+    print(f"    {n_nonzero} non-zero values in {len(stats.columns)} columns "
+          f"({n_nonzero / max(n_cells, 1) * 100:.2f}% of {n_cells} cells)")
+    if n_rows:
+        print(stats.to_frame())
+
+def print_viewing_hint(output, output_format, names_with_commas):
+    """
+    Suggest a terminal command to page through a written csv or csv.gz table.
+
+    The sed form, which keeps quoted names with commas in one column, is only
+    suggested when `names_with_commas` says it is needed.
+    """
+    if output_format not in ('csv', 'csv.gz'):
+        return
+    reader = f"gzip -cd {output} | " if output_format == 'csv.gz' else ""
+    source = "" if reader else f" {output}"
+    if names_with_commas:
+        print(f"""\nConsider running `{reader}sed -E 's/"([^"]*),([^"]*)"/"\\1|\\2"/g'{source} | column -s, -t | less -S` to see the full table.\n""")
+    elif reader:
+        print(f"\nConsider running `{reader}column -s, -t | less -S` to see the full table.\n")
+    else:
+        print(f"\nConsider running `column -s, -t {output} | less -S` to see the full table.\n")
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """
+    Return the peak resident memory, in MB, of this process (or of its largest finished child).
+
+    This is the high-water mark since the process started, or on Linux since the
+    last `reset_peak_rss`.
+    """
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(who).ru_maxrss
+    return max_rss * (1 if sys.platform == 'darwin' else 1024) / 1024**2
+
+def proc_status_mb(field):
+    """
+    Return a memory field of /proc/self/status, e.g. 'VmRSS' (current) or 'VmHWM' (peak), in MB.
+
+    Returns None where /proc is not available.
+    """
+    try:
+        with open('/proc/self/status', 'rt') as fp:
+            for line in fp:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def reset_peak_rss():
+    """
+    Reset the resident memory high-water mark (VmHWM) of this process, so the next
+    reading covers only what runs after it. Linux only.
+
+    Returns:
+        bool: Whether the reset took effect.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'wt') as fp:
+            fp.write('5')
+    except OSError:
+        return False
+    return proc_status_mb('VmHWM') is not None
+
+class StageProfiler:
+    """
+    Per-stage wall time, table shapes and memory for --profile-json.
+
+    Stages are marked with `start(name)` and `stop(**counts)`; the counts are the
+    rows_in/columns_in/rows_out/columns_out (or files, samples, entries) already at
+    hand, so profiling never forces extra work. Starting a stage stops the previous
+    one. Without a path every call is a no-op.
+
+    Each stage records its resident memory at start and end ('rss_start_mb',
+    'rss_end_mb') and 'peak_rss_mb'. On Linux the high-water mark is reset when a stage
+    starts, so 'peak_rss_mb' is the highest RSS during that stage alone
+    ('peak_rss_scope': 'stage'). Elsewhere it is the process high-water mark so far
+    ('peak_rss_scope': 'process'), which later stages can only repeat or raise.
+    The top-level 'peak_rss_mb' is the peak of the whole run.
+    """
+
+    def __init__(self, path=None, command=None, plans=False):
+        self.path = path
+        self.command = command
+        self.plans = {} if plans else None
+        self.completed = False
+        self.stages = []
+        self._current = None
+        self._started = time.perf_counter()
+        self._peak = peak_rss_mb() if path is not None else 0
+
+    def _rss_mb(self):
+        rss = proc_status_mb('VmRSS')
+        return rss if rss is not None else peak_rss_mb()
+
+    def start(self, name):
+        if self.path is None:
+            return
+        if self._current is not None:
+            self.stop()
+        self._peak = max(self._peak, proc_status_mb('VmHWM') or peak_rss_mb())
+        scope = 'stage' if reset_peak_rss() else 'process'
+        self._current = dict(stage=name, seconds=time.perf_counter(), rss_start_mb=self._rss_mb(),
+                             peak_rss_scope=scope)
+
+    def stop(self, **counts):
+        if self.path is None or self._current is None:
+            return
+        stage, self._current = self._current, None
+        stage['seconds'] = time.perf_counter() - stage['seconds']
+        stage.update(counts)
+        stage['rss_end_mb'] = self._rss_mb()
+        if stage['peak_rss_scope'] == 'stage':
+            stage['peak_rss_mb'] = proc_status_mb('VmHWM')
+        else:
+            stage['peak_rss_mb'] = peak_rss_mb()
+        self._peak = max(self._peak, stage['peak_rss_mb'])
+        self.stages.append(stage)
+
+    def plan(self, name, lazy_frame):
+        """
+        Record the optimized query plan of `lazy_frame` (with plans=True).
+        """
+        if self.path is not None and self.plans is not None:
+            self.plans[name] = lazy_frame.explain()
+
+    def write(self):
+        if self.path is None:
+            return
+        if self._current is not None:
+            self.stop()
+        report = dict(command=self.command, argv=sys.argv[1:], completed=self.completed,
+                      seconds=time.perf_counter() - self._started,
+                      peak_rss_mb=max(self._peak, proc_status_mb('VmHWM') or 0, peak_rss_mb()),
+                      children_peak_rss_mb=peak_rss_mb(resource.RUSAGE_CHILDREN),
+                      stages=self.stages)
+        if self.plans is not None:
+            report['plans'] = self.plans
+        with open(self.path, 'wt') as fp:
+            json.dump(report, fp, indent=1)
+        print(f"Wrote the stage profile to '{self.path}'.")
+
+# the benchmarks run by `tables_bench`, in order; compare_rows reads gather_dense's table
+BENCHMARKS = ('gather_dense', 'gather_sparse', 'gather_taxonomy', 'prefetch', 'hash_tables', 'compare_rows')
+
+def make_synthetic_cohort(directory, n_files=50, n_matches=200, n_genomes=2000, n_sketches=200, n_hashes=20000, seed=1):
+    """
+    Write a synthetic cohort for `tables_bench`: gather and prefetch CSVs, a taxonomy,
+    a ranktable and two zips of sketches.
+
+    Parameters:
+        directory (str): Where to write the files.
+        n_files (int): Number of gather CSV files, each holding one query, and as many prefetch CSVs.
+        n_matches (int): Matches per gather CSV, drawn from `n_genomes` reference genomes;
+                         each prefetch CSV lists twice as many.
+        n_sketches (int): Number of abundance-tracking scaled=1000 sketches in 'sketches.zip';
+                          'sketches_2.zip' holds half as many other samples.
+        n_hashes (int): Number of hashvals in the ranktable; each sketch holds about 10% of them.
+
+    Returns:
+        dict: Paths of the 'gather' and 'prefetch' CSVs and the 'taxonomy', 'ranktable',
+              'sketches' and 'sketches_2' files.
+    """
+    from sourmash.save_load import SaveSignaturesToLocation
+
+    rng = np.random.default_rng(seed)
+    gather_dir = os.path.join(directory, 'gather')
+    os.makedirs(gather_dir, exist_ok=True)
+
+    idents = [f"GCF_{i:09d}" for i in range(n_genomes)]
+    species = rng.integers(0, max(n_genomes // 4, 1), size=n_genomes)
+    taxonomy = os.path.join(directory, 'taxonomy.csv')
+    pl.DataFrame({
+        'ident': idents,
+        'superkingdom': ['d__Bacteria'] * n_genomes,
+        'phylum': [f"p__Phylum_{s // 500}" for s in species],
+        'family': [f"f__Family_{s // 50}" for s in species],
+        'genus': [f"g__Genus_{s // 5}" for s in species],
+        'species': [f"s__Species_{s}" for s in species],
+    }).write_csv(taxonomy)
+
+    gather_csvs = []
+    n_matches = min(n_matches, n_genomes)
+    for i in range(n_files):
+        query = f"SAMPLE{i:06d}"
+        match_ids = rng.choice(n_genomes, size=n_matches, replace=False)
+        intersect_bp = np.sort(rng.integers(1, 500, size=n_matches))[::-1] * 1000
+        path = os.path.join(gather_dir, f"{query}.gather.csv")
+        pl.DataFrame({
+            'query_filename': ['-'] * n_matches,
+            'rank': np.arange(n_matches),
+            'query_name': [query] * n_matches,
+            'match_name': [f"{idents[j]} s__Species_{species[j]}" for j in match_ids],
+            'intersect_bp': intersect_bp,
+            'f_unique_weighted': intersect_bp / intersect_bp.sum(),
+        }).write_csv(path)
+        gather_csvs.append(path)
+
+    prefetch_dir = os.path.join(directory, 'prefetch')
+    os.makedirs(prefetch_dir, exist_ok=True)
+    prefetch_csvs = []
+    n_overlaps = min(2 * n_matches, n_genomes)
+    for i in range(n_files):
+        query = f"SAMPLE{i:06d}"
+        match_ids = rng.choice(n_genomes, size=n_overlaps, replace=False)
+        intersect_bp = rng.integers(1, 500, size=n_overlaps) * 1000
+        match_bp = intersect_bp + rng.integers(0, 5000, size=n_overlaps) * 1000
+        path = os.path.join(prefetch_dir, f"{query}.prefetch.csv")
+        pl.DataFrame({
+            'intersect_bp': intersect_bp,
+            'jaccard': intersect_bp / (match_bp + 5_000_000),
+            'match_name': [f"{idents[j]} s__Species_{species[j]}" for j in match_ids],
+            'match_bp': match_bp,
+            'query_name': [query] * n_overlaps,
+            'query_bp': [5_000_000] * n_overlaps,
+        }).write_csv(path)
+        prefetch_csvs.append(path)
+
+    hashvals = np.unique(rng.integers(1, 2**64 // 1000, size=n_hashes, dtype=np.uint64))
+    ranktable = os.path.join(directory, 'ranktable.csv')
+    pl.DataFrame({'hashval': hashvals,
+                  'species': [f"s__Species_{h % max(n_genomes // 4, 1)}" for h in hashvals.tolist()]}
+                 ).write_csv(ranktable)
+
+    collections = {'sketches': (0, n_sketches), 'sketches_2': (n_sketches, n_sketches + max(n_sketches // 2, 1))}
+    for key, (first, last) in collections.items():
+        path = os.path.join(directory, f'{key}.zip')
+        if os.path.exists(path):
+            os.unlink(path)
+        with SaveSignaturesToLocation(path) as save_sigs:
+            for i in range(first, last):
+                mh = sourmash.MinHash(n=0, ksize=31, scaled=1000, track_abundance=True)
+                present = rng.choice(hashvals, size=max(len(hashvals) // 10, 1), replace=False)
+                abunds = rng.integers(1, 100, size=len(present))
+                mh.set_abundances(dict(zip(present.tolist(), abunds.tolist())))
+                save_sigs.add(sourmash.SourmashSignature(mh, name=f"SAMPLE{i:06d}"))
+
+    return dict(gather=gather_csvs, prefetch=prefetch_csvs, taxonomy=taxonomy, ranktable=ranktable,
+                sketches=os.path.join(directory, 'sketches.zip'),
+                sketches_2=os.path.join(directory, 'sketches_2.zip'))
+
+def benchmark_command(name, cohort, directory):
+    """
+    Return the `sourmash scripts` subcommand of one `tables_bench` benchmark and its arguments.
+
+    Returns:
+        tuple: (subcommand, [arguments])
+    """
+    out = lambda filename: os.path.join(directory, filename)
+    if name == 'gather_dense':
+        return 'gather_tables', [*cohort['gather'], '-o', out('gather_dense.csv')]
+    elif name == 'gather_sparse':
+        return 'gather_tables', [*cohort['gather'], '-f', 'sparse', '-o', out('gather_sparse.csv')]
+    elif name == 'gather_taxonomy':
+        return 'gather_tables', [*cohort['gather'], '-t', cohort['taxonomy'], '-l', 'genus',
+                                 '-o', out('gather_genus.csv')]
+    elif name == 'prefetch':
+        return 'prefetch_tables', [*cohort['prefetch'], '-o', out('prefetch_dense.csv')]
+    elif name == 'hash_tables':
+        return 'hash_tables', [cohort['ranktable'], cohort['sketches'], '--scaled', '1000',
+                               '-o', out('hash_tables.csv')]
+    elif name == 'compare_rows':
+        return 'compare_rows', [out('compare_1.csv'), out('compare_2.csv'), '-m', 'jaccard',
+                                '-o', out('compare_rows.csv')]
+    raise ValueError(f"Unknown benchmark '{name}'.")
+
+def benchmark_setup(name, cohort, directory):
+    """
+    Return the untimed commands that build the inputs of one `tables_bench` benchmark,
+    as (subcommand, [arguments]) tuples.
+
+    compare_rows compares the hash_tables presence tables of the two sketch collections.
+    """
+    if name == 'compare_rows':
+        return [('hash_tables', [cohort['ranktable'], cohort[key], '--scaled', '1000',
+                                 '-o', os.path.join(directory, f'compare_{n}.csv')])
+                for n, key in enumerate(('sketches', 'sketches_2'), start=1)]
+    return []
+
+def fold_cohort_files(arguments, cohort):
+    """
+    Replace the gather and prefetch CSVs in `arguments` by one glob each, for the results file.
+    """
+    folded = list(arguments)
+    for key in ('gather', 'prefetch'):
+        paths = set(cohort[key])
+        kept = [arg for arg in folded if arg not in paths]
+        if len(kept) < len(folded):
+            pattern = os.path.join(os.path.dirname(cohort[key][0]), f'*.{key}.csv')
+            kept.insert(0, pattern)
+        folded = kept
+    return folded
+
+def run_benchmark(cmd, log):
+    """
+    Run one benchmark command in a child process, appending its output to `log`.
+
+    Returns:
+        dict: 'wall_seconds', 'max_rss_mb' (peak resident memory of the child) and 'returncode'.
+    """
+    with open(log, 'at') as fp:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, stdout=fp, stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS, as in `peak_rss_mb`
+    max_rss = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return dict(wall_seconds=wall, max_rss_mb=max_rss / 1024**2, returncode=proc.returncode)
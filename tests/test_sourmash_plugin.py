@@ -1,13 +1,31 @@
 """
 Tests for sourmash_plugin_xyz.
 """
+import glob
+import gzip
+import json
 import os
+import random
+import shutil
+import types
 import pytest
 
+import numpy as np
+import polars as pl
+import scipy.io
+import scipy.sparse
+
 import sourmash
+from sourmash import MinHash, SourmashSignature, save_signatures_to_json
+from sourmash.minhash import _get_max_hash_for_scaled
+from sourmash.save_load import SaveSignaturesToLocation
 import sourmash_tst_utils as utils
 from sourmash_tst_utils import SourmashCommandFailed
 
+from sourmash_plugin_tables import (PresenceMatrix, TableStats, build_hashval_index, collapse_column_groups,
+                                    evict_cache, iter_sketch_rows, load_ranktable_index, map_hashes_to_rows,
+                                    read_column_groups, scan_inputs, write_gzip_members)
+
 
 def test_run_sourmash(runtmp):
     with pytest.raises(SourmashCommandFailed):
@@ -16,3 +34,837 @@ def test_run_sourmash(runtmp):
     print(runtmp.last_result.out)
     print(runtmp.last_result.err)
     assert runtmp.last_result.status != 0                    # no args provided, ok ;)
+
+
+def make_hash_inputs(location, n_samples=4, n_hashes=50, seed=1, track_abundance=False):
+    "Write a small ranktable and a .sig file of random scaled=1000 sketches."
+    rng = random.Random(seed)
+    pool = [rng.randrange(2**64 // 1000) for _ in range(n_hashes * 2)]
+
+    ranktable = os.path.join(location, 'ranktable.csv')
+    with open(ranktable, 'wt') as fp:
+        fp.write('hashval,species\n')
+        for h in pool[:n_hashes]:
+            fp.write(f'{h},s__{h % 3}\n')
+
+    sigs = []
+    for i in range(n_samples):
+        mh = MinHash(n=0, ksize=31, scaled=1000, track_abundance=track_abundance)
+        if track_abundance:
+            mh.set_abundances({h: rng.randint(1, 20) for h in rng.sample(pool, n_hashes // 2)})
+        else:
+            mh.add_many(rng.sample(pool, n_hashes // 2))
+        sigs.append(SourmashSignature(mh, name=f'sample{i}'))
+
+    sketches = os.path.join(location, 'sketches.sig')
+    with open(sketches, 'wb') as fp:
+        save_signatures_to_json(sigs, fp)
+
+    return ranktable, sketches, pool[:n_hashes], sigs
+
+
+def test_map_hashes_to_rows():
+    hash_index = build_hashval_index(pl.Series('hashval', [5, 3, 9, 3, 1]))
+    rows = map_hashes_to_rows(hash_index, [3, 9, 4, 1, 100])
+
+    assert list(rows) == [1, 2, 3, 4]
+
+
+def test_hash_tables_presence(runtmp):
+    ranktable, sketches, hashvals, sigs = make_hash_inputs(runtmp.location)
+    output = runtmp.output('presence.csv')
+
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, sketches,
+                    '--scaled', '1000', '-o', output)
+
+    df = pl.read_csv(output)
+    assert df.columns == ['hashval'] + [ss.name for ss in sigs]
+    assert df['hashval'].to_list() == hashvals
+    for ss in sigs:
+        expected = [int(h in ss.minhash.hashes) for h in hashvals]
+        assert df[ss.name].to_list() == expected
+
+
+def test_hash_tables_progress(runtmp):
+    ranktable, sketches, hashvals, sigs = make_hash_inputs(runtmp.location, n_samples=25)
+
+    # progress is reported every 10 sketches, even when they all come from one file
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, sketches,
+                    '--scaled', '1000', '-o', runtmp.output('presence.csv'))
+    assert '... 10 of 25 selected sketches (40.00%)' in runtmp.last_result.out
+    assert '... 20 of 25 selected sketches (80.00%)' in runtmp.last_result.out
+
+
+def test_hash_tables_cores(runtmp):
+    ranktable, sketches, hashvals, sigs = make_hash_inputs(runtmp.location)
+
+    # split the sketches across two files so there is work for two processes
+    split = []
+    for i, part in enumerate((sigs[:2], sigs[2:])):
+        split.append(runtmp.output(f'part{i}.sig'))
+        with open(split[-1], 'wb') as fp:
+            save_signatures_to_json(part, fp)
+
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, sketches,
+                    '--scaled', '1000', '-o', runtmp.output('serial.csv'))
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, *split,
+                    '--scaled', '1000', '--cores', '2',
+                    '-o', runtmp.output('parallel.csv'))
+
+    assert 'Using 2 processes' in runtmp.last_result.out
+    serial = pl.read_csv(runtmp.output('serial.csv'))
+    parallel = pl.read_csv(runtmp.output('parallel.csv'))
+    assert serial.equals(parallel)
+
+
+def test_gather_tables_cores(runtmp):
+    gather_csvs = sorted(glob.glob(utils.get_test_data('crc-human-saliva/*.csv')))
+    empty = runtmp.output('empty.gather.csv')
+    open(empty, 'wt').close()
+
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, empty,
+                    '--cores', '1', '-o', runtmp.output('serial.csv'))
+    runtmp.sourmash('scripts', 'gather_tables', empty, *gather_csvs,
+                    '--cores', '4', '-o', runtmp.output('threaded.csv'))
+
+    serial = pl.read_csv(runtmp.output('serial.csv'))
+    threaded = pl.read_csv(runtmp.output('threaded.csv'))
+    assert serial.equals(threaded)
+    assert serial.columns[1:] == [f'ERR27648{i}' for i in range(77, 82)]
+
+    with open(runtmp.output('skipped-files.txt')) as fp:
+        assert 'empty.gather.csv' in fp.read()
+
+
+def test_gather_tables_streaming(runtmp):
+    gather_csvs = sorted(glob.glob(utils.get_test_data('healthy-human-stool/*.csv')))
+
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs,
+                    '-o', runtmp.output('dense.csv'))
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs,
+                    '--streaming', '--chunk-size', '10',
+                    '-o', runtmp.output('streamed.csv'))
+
+    with open(runtmp.output('dense.csv')) as fp1, open(runtmp.output('streamed.csv')) as fp2:
+        assert fp1.read() == fp2.read()
+
+
+def test_gather_tables_duplicate_entries(runtmp):
+    gather_csvs = sorted(glob.glob(utils.get_test_data('crc-human-saliva/*.csv')))
+    copy = runtmp.output('copy.gather.csv')
+    shutil.copyfile(gather_csvs[0], copy)
+
+    # the same query in two inputs is rejected alike by the pivot, streaming and sparse paths
+    for extra in ([], ['--streaming'], ['-f', 'mtx']):
+        with pytest.raises(SourmashCommandFailed):
+            runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, copy, *extra,
+                            '-o', runtmp.output('dup.csv'))
+        assert 'Found more than one value for match_name' in runtmp.last_result.err
+
+
+def test_gather_tables_cache_dir(runtmp):
+    gather_csvs = sorted(glob.glob(utils.get_test_data('crc-human-stool/*.csv')))
+    cache_dir = runtmp.output('cache')
+
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs,
+                    '-o', runtmp.output('plain.csv'))
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '--cache-dir', cache_dir,
+                    '-o', runtmp.output('cold.csv'))
+    cached = sorted(os.listdir(cache_dir))
+    assert len(cached) == len(gather_csvs)
+
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '--cache-dir', cache_dir,
+                    '-o', runtmp.output('warm.csv'))
+    assert sorted(os.listdir(cache_dir)) == cached
+
+    # a run never evicts the cache files it is still scanning
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '--cache-dir', cache_dir,
+                    '--cache-max-size', '0', '-o', runtmp.output('tiny.csv'))
+    assert sorted(os.listdir(cache_dir)) == cached
+
+    outputs = [open(runtmp.output(f'{name}.csv')).read() for name in ('plain', 'cold', 'warm', 'tiny')]
+    assert outputs[0] == outputs[1] == outputs[2] == outputs[3]
+
+    # least recently used files go first, except those in use
+    assert evict_cache(cache_dir, 0, keep=[os.path.join(cache_dir, cached[0])]) == len(cached) - 1
+    assert os.listdir(cache_dir) == [cached[0]]
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '--cache-dir', cache_dir,
+                    '-o', runtmp.output('warm.csv'))
+    cached = sorted(os.listdir(cache_dir))
+
+    for n, name in enumerate(cached):
+        os.utime(os.path.join(cache_dir, name), (n, n))
+    size = os.path.getsize(os.path.join(cache_dir, cached[-1]))
+    assert evict_cache(cache_dir, size) == len(cached) - 1
+    assert os.listdir(cache_dir) == [cached[-1]]
+
+
+def make_taxonomy(location, gather_csvs):
+    "Write a taxonomy with genus and species for each match in the gather CSVs."
+    names = pl.concat([pl.read_csv(f) for f in gather_csvs])['match_name'].unique().sort()
+    rows = []
+    for name in names:
+        ident, species = name.split(' ', 1)
+        genus = species.split(' ')[0].replace('s__', 'g__')
+        rows.append((ident, genus, species))
+
+    taxonomy = os.path.join(location, 'taxonomy.csv')
+    pl.DataFrame(rows, schema=['ident', 'genus', 'species'], orient='row').write_csv(taxonomy)
+    return taxonomy
+
+
+def test_gather_tables_taxonomy(runtmp):
+    gather_csvs = sorted(glob.glob(utils.get_test_data('crc-human-saliva/*.csv')))
+    taxonomy = make_taxonomy(runtmp.location, gather_csvs)
+
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '-t', taxonomy,
+                    '-l', 'genus', '-o', runtmp.output('genus0.csv'))
+    assert not os.path.exists(taxonomy + '.parquet')
+
+    cache_dir = runtmp.output('cache')
+    for n in range(1, 3):
+        runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '-t', taxonomy, '--cache-dir', cache_dir,
+                        '-l', 'genus', '-o', runtmp.output(f'genus{n}.csv'))
+
+    df = pl.read_csv(runtmp.output('genus1.csv'))
+    assert df.equals(pl.read_csv(runtmp.output('genus0.csv')))
+    assert df.equals(pl.read_csv(runtmp.output('genus2.csv')))
+
+    # a taxonomy replaced by one with an older mtime (cp -p, rsync) must not hit the cache
+    stat = os.stat(taxonomy)
+    tax = pl.read_csv(taxonomy)
+    tax.with_columns(pl.lit('g__Replaced').alias('genus')).write_csv(taxonomy)
+    os.utime(taxonomy, ns=(stat.st_atime_ns, stat.st_mtime_ns - 10**9))
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '-t', taxonomy, '--cache-dir', cache_dir,
+                    '-l', 'genus', '-o', runtmp.output('replaced.csv'))
+    replaced = pl.read_csv(runtmp.output('replaced.csv'))
+    assert replaced['match_name_genus'].drop_nulls().unique().to_list() == ['g__Replaced']
+
+    long_df = pl.concat([pl.read_csv(f) for f in gather_csvs])
+    expected = (
+            long_df
+            .with_columns(pl.col('match_name').str.split(' ').list.get(1).str.replace('s__', 'g__').alias('genus'))
+            .filter((pl.col('genus') == 'g__Streptococcus') & (pl.col('query_name') == 'ERR2764877')
+                    & (pl.col('intersect_bp') >= 1000))
+            )['intersect_bp'].sum()
+    row = df.filter(pl.col('match_name_genus') == 'g__Streptococcus')
+    assert row['ERR2764877'].item() == expected
+
+
+def test_gather_tables_multiple_ranks(runtmp):
+    gather_csvs = sorted(glob.glob(utils.get_test_data('crc-human-stool/*.csv')))
+    taxonomy = make_taxonomy(runtmp.location, gather_csvs)
+
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '-t', taxonomy,
+                    '-l', 'genus,species', '-o', runtmp.output('multi.csv'))
+
+    for rank in ('genus', 'species'):
+        runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '-t', taxonomy,
+                        '-l', rank, '-o', runtmp.output(f'{rank}.csv'))
+        with open(runtmp.output(f'multi.{rank}.csv')) as fp1, open(runtmp.output(f'{rank}.csv')) as fp2:
+            assert fp1.read() == fp2.read()
+
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '-t', taxonomy,
+                    '--all-ranks', '-o', runtmp.output('all.csv'))
+    assert os.path.exists(runtmp.output('all.genus.csv'))
+    assert os.path.exists(runtmp.output('all.species.csv'))
+
+    # --all-ranks without -t, or with a taxonomy lacking every lineage rank, is an error
+    with pytest.raises(SourmashCommandFailed):
+        runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '--all-ranks', '-o', runtmp.output('none.csv'))
+    assert '--all-ranks requires a taxonomy file' in runtmp.last_result.err
+
+    no_ranks = runtmp.output('no_ranks.csv')
+    with open(no_ranks, 'wt') as fp:
+        fp.write('ident,label\nGCF_000001,x\n')
+    with pytest.raises(SourmashCommandFailed):
+        runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '-t', no_ranks,
+                        '--all-ranks', '-o', runtmp.output('none.csv'))
+    assert 'No lineage rank columns' in runtmp.last_result.err
+
+
+def test_gather_tables_output_format_from_extension(runtmp):
+    gather_csvs = sorted(glob.glob(utils.get_test_data('crc-human-saliva/*.csv')))
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '-o', runtmp.output('table.csv'))
+    expected = pl.read_csv(runtmp.output('table.csv'))
+
+    # without --output-format the container follows -o, as in compare_rows
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '-o', runtmp.output('table.parquet'))
+    assert pl.read_parquet(runtmp.output('table.parquet')).equals(expected)
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '-o', runtmp.output('inferred.csv.gz'))
+    assert pl.read_csv(runtmp.output('inferred.csv.gz')).equals(expected)
+
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '--output-format', 'csv',
+                    '-o', runtmp.output('mismatch.parquet'))
+    assert 'WARNING: writing csv output' in runtmp.last_result.out
+
+    # -z only writes csv.gz
+    with pytest.raises(SourmashCommandFailed):
+        runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '-z', '--output-format', 'parquet',
+                        '-o', runtmp.output('z.parquet'))
+    assert '-z writes csv.gz' in runtmp.last_result.err
+
+
+@pytest.mark.parametrize('output_format', ['csv.gz', 'parquet', 'ipc'])
+def test_gather_tables_output_format(runtmp, output_format):
+    gather_csvs = sorted(glob.glob(utils.get_test_data('crc-human-saliva/*.csv')))
+
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs,
+                    '-o', runtmp.output('table.csv'))
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '--output-format', output_format,
+                    '-o', runtmp.output(f'table.{output_format}'))
+
+    expected = pl.read_csv(runtmp.output('table.csv'))
+    if output_format == 'csv.gz':
+        actual = pl.read_csv(runtmp.output('table.csv.gz'))
+    elif output_format == 'parquet':
+        actual = pl.read_parquet(runtmp.output('table.parquet'))
+    else:
+        actual = pl.read_ipc(runtmp.output('table.ipc'))
+    assert expected.equals(actual)
+
+
+def test_gather_tables_parquet_input(runtmp):
+    gather_csvs = sorted(glob.glob(utils.get_test_data('crc-human-saliva/*.csv')))
+    gather_parquets = []
+    for filename in gather_csvs:
+        gather_parquets.append(runtmp.output(os.path.basename(filename) + '.parquet'))
+        pl.read_csv(filename).write_parquet(gather_parquets[-1])
+
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '-o', runtmp.output('csv.csv'))
+    runtmp.sourmash('scripts', 'gather_tables', *gather_parquets, '-o', runtmp.output('parquet.csv'))
+
+    with open(runtmp.output('csv.csv')) as fp1, open(runtmp.output('parquet.csv')) as fp2:
+        assert fp1.read() == fp2.read()
+
+
+@pytest.mark.parametrize('matrix_format', ['mtx', 'npz'])
+def test_gather_tables_sparse_matrix(runtmp, matrix_format):
+    gather_csvs = sorted(glob.glob(utils.get_test_data('crc-human-saliva/*.csv')))
+
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '-o', runtmp.output('dense.csv'))
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '-f', matrix_format,
+                    '-o', runtmp.output(f'table.{matrix_format}'))
+
+    if matrix_format == 'mtx':
+        matrix = scipy.io.mmread(runtmp.output('table.mtx')).toarray()
+    else:
+        matrix = scipy.sparse.load_npz(runtmp.output('table.npz')).toarray()
+
+    dense = pl.read_csv(runtmp.output('dense.csv'))
+    assert (matrix == dense.drop('match_name').to_numpy()).all()
+    with open(runtmp.output('table.rows.txt')) as fp:
+        assert fp.read().splitlines() == dense['match_name'].to_list()
+    with open(runtmp.output('table.cols.txt')) as fp:
+        assert fp.read().splitlines() == dense.columns[1:]
+
+
+def test_hash_tables_sparse_matrix(runtmp):
+    ranktable, sketches, hashvals, sigs = make_hash_inputs(runtmp.location)
+
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, sketches, '--scaled', '1000',
+                    '-o', runtmp.output('dense.csv'))
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, sketches, '--scaled', '1000',
+                    '--format', 'mtx', '-o', runtmp.output('presence.mtx'))
+
+    matrix = scipy.io.mmread(runtmp.output('presence.mtx')).toarray()
+    dense = pl.read_csv(runtmp.output('dense.csv'))
+    assert (matrix == dense.drop('hashval').to_numpy()).all()
+    with open(runtmp.output('presence.rows.txt')) as fp:
+        assert [int(x) for x in fp.read().splitlines()] == hashvals
+
+
+def test_compare_rows(runtmp):
+    ranktable, sketches, hashvals, sigs = make_hash_inputs(runtmp.location)
+    table = runtmp.output('presence.csv')
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, sketches, '--scaled', '1000', '-o', table)
+
+    for mode in ('count', 'matches', 'jaccard'):
+        runtmp.sourmash('scripts', 'compare_rows', table, table, '-m', mode,
+                        '-o', runtmp.output(f'{mode}.csv'))
+
+    counts = pl.read_csv(runtmp.output('count.csv'))
+    matches = pl.read_csv(runtmp.output('matches.csv'), infer_schema_length=0)
+    jaccard = pl.read_csv(runtmp.output('jaccard.csv'))
+
+    present = {ss.name: set(h for h in hashvals if h in ss.minhash.hashes) for ss in sigs}
+    for i, ss1 in enumerate(sigs):
+        assert counts['Identifier_1'][i] == ss1.name
+        for ss2 in sigs:
+            shared = present[ss1.name] & present[ss2.name]
+            union = present[ss1.name] | present[ss2.name]
+            assert counts[ss2.name][i] == len(shared)
+            assert set(int(h) for h in matches[ss2.name][i].split(';')) == shared
+            assert jaccard[ss2.name][i] == pytest.approx(len(shared) / len(union))
+
+
+def test_compare_rows_duplicate_index(runtmp):
+    # 'b' is listed twice, as a ranktable with a repeated hashval produces
+    table_1 = runtmp.output('one.csv')
+    table_2 = runtmp.output('two.csv')
+    pl.DataFrame({'match_name': ['a', 'b', 'b', 'c'], 'S1': [1, 1, 1, 0]}).write_csv(table_1)
+    pl.DataFrame({'match_name': ['a', 'b', 'c'], 'S2': [0, 1, 1]}).write_csv(table_2)
+
+    for mode in ('count', 'matches', 'jaccard', 'containment'):
+        runtmp.sourmash('scripts', 'compare_rows', table_1, table_2, '-m', mode,
+                        '-o', runtmp.output(f'{mode}.csv'))
+
+    assert pl.read_csv(runtmp.output('count.csv'))['S2'].item() == 1
+    assert pl.read_csv(runtmp.output('matches.csv'))['S2'].item() == 'b'
+    assert pl.read_csv(runtmp.output('jaccard.csv'))['S2'].item() == pytest.approx(1 / 3)
+    assert pl.read_csv(runtmp.output('containment.csv'))['S2'].item() == pytest.approx(1 / 2)
+
+
+def test_hash_tables_bits(runtmp):
+    ranktable, sketches, hashvals, sigs = make_hash_inputs(runtmp.location)
+    group = runtmp.output('group.txt')
+    with open(group, 'wt') as fp:
+        fp.write('groupA\nsample0\nsample2\n')
+
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, sketches, '--scaled', '1000',
+                    '-o', runtmp.output('presence.csv'))
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, sketches, '--scaled', '1000',
+                    '--format', 'bits', '-o', runtmp.output('presence.bits'))
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, sketches, '--scaled', '1000',
+                    '--total-count', '-o', runtmp.output('total.csv'))
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, sketches, '--scaled', '1000',
+                    '--collapse-columns', group, '-o', runtmp.output('collapsed.csv'))
+
+    # incompatible options are rejected before any sketch is mapped
+    for extra in (['--collapse-columns', group], ['--total-count'], ['--abundance', 'count']):
+        with pytest.raises(SourmashCommandFailed):
+            runtmp.sourmash('scripts', 'hash_tables', ranktable, sketches, '--scaled', '1000',
+                            '--format', 'bits', *extra, '-o', runtmp.output('rejected.bits'))
+        assert '--format bits cannot be combined' in runtmp.last_result.err
+        assert 'Loading' not in runtmp.last_result.out
+
+    presence = pl.read_csv(runtmp.output('presence.csv'))
+    total = pl.read_csv(runtmp.output('total.csv'))
+    for ss in sigs:
+        assert total[ss.name].item() == presence[ss.name].sum()
+    assert total['count'].item() == sum(presence[ss.name].sum() for ss in sigs)
+
+    collapsed = pl.read_csv(runtmp.output('collapsed.csv'))
+    assert collapsed['groupA'].to_list() == (presence['sample0'] + presence['sample2']).to_list()
+
+    # compare_rows reads the packed matrix directly
+    runtmp.sourmash('scripts', 'compare_rows', runtmp.output('presence.bits'), runtmp.output('presence.csv'),
+                    '-m', 'count', '-o', runtmp.output('bits-count.csv'))
+    runtmp.sourmash('scripts', 'compare_rows', runtmp.output('presence.csv'), runtmp.output('presence.csv'),
+                    '-m', 'count', '-o', runtmp.output('csv-count.csv'))
+    assert pl.read_csv(runtmp.output('bits-count.csv')).equals(pl.read_csv(runtmp.output('csv-count.csv')))
+
+    # two bitsets over the same hashvals are intersected word by word
+    for mode in ('count', 'matches', 'jaccard', 'containment'):
+        runtmp.sourmash('scripts', 'compare_rows', runtmp.output('presence.bits'), runtmp.output('presence.bits'),
+                        '-m', mode, '-o', runtmp.output(f'bits-{mode}.csv'))
+        assert 'intersecting the words directly' in runtmp.last_result.out
+        runtmp.sourmash('scripts', 'compare_rows', runtmp.output('presence.csv'), runtmp.output('presence.csv'),
+                        '-m', mode, '-o', runtmp.output(f'csv-{mode}.csv'))
+        assert pl.read_csv(runtmp.output(f'bits-{mode}.csv')).equals(pl.read_csv(runtmp.output(f'csv-{mode}.csv')))
+
+
+def test_presence_matrix_packing():
+    presence = PresenceMatrix(200)
+    sparse_rows = np.array([3, 150], dtype=np.uint32)
+    dense_rows = np.arange(0, 200, 2, dtype=np.uint32)
+    presence.add('sparse', sparse_rows)
+    presence.add('dense', dense_rows)
+
+    # 100 hits cost more as indices than 4 words, so only the dense sample is packed
+    assert presence._packed == {'dense'}
+    assert list(presence.counts()) == [2, 100]
+    assert presence.nnz == 102
+    assert [list(rows) for rows in presence.sample_rows()] == [list(sparse_rows), list(dense_rows)]
+
+    df = presence.to_frame(pl.Series('hashval', range(200)))
+    assert df['dense'].to_list() == [1 - i % 2 for i in range(200)]
+    assert df['sparse'].sum() == 2
+    assert presence.to_sparse().sum() == 102
+
+    # group sums decode one sample at a time and match the sparse product
+    indicator = scipy.sparse.csr_array(np.array([[1, 0], [1, 2]], dtype=np.int32))
+    sums = presence.group_sums(indicator)
+    assert sums.dtype == np.int32
+    assert sums.tolist() == (presence.to_sparse().T @ indicator).toarray().tolist()
+
+
+def test_gather_tables_append_to(runtmp):
+    gather_csvs = []
+    for filename in sorted(glob.glob(utils.get_test_data('crc-human-saliva/*.csv'))):
+        gather_csvs.append(runtmp.output(os.path.basename(filename)))
+        shutil.copy(filename, gather_csvs[-1])
+    table = runtmp.output('table.parquet')
+
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs[:3], '--append-to', table,
+                    '--output-format', 'parquet', '-o', table)
+    # change one input that is already in the table
+    changed = pl.read_csv(gather_csvs[0])
+    changed.head(5).write_csv(gather_csvs[0])
+
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '--append-to', table,
+                    '--output-format', 'parquet', '-o', table)
+    assert '2 file(s) already in' in runtmp.last_result.out
+
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '-o', runtmp.output('full.csv'))
+    full = pl.read_csv(runtmp.output('full.csv'))
+    appended = pl.read_parquet(table)
+
+    assert sorted(appended.columns) == sorted(full.columns)
+    appended = appended.select(full.columns)
+    assert appended.sort('match_name').equals(full.sort('match_name'))
+    assert len(pl.read_csv(table + '.manifest.csv')) == len(gather_csvs)
+
+    # a changed input that is now empty drops its query, and is not retried by the next run
+    open(gather_csvs[1], 'wt').close()
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '--append-to', table,
+                    '--output-format', 'parquet', '-o', table)
+    assert 'Dropping 1 queries of changed inputs' in runtmp.last_result.out
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '-o', runtmp.output('full.csv'))
+    full = pl.read_csv(runtmp.output('full.csv'))
+    appended = pl.read_parquet(table)
+    assert sorted(appended.columns) == sorted(full.columns)
+    assert appended.select(full.columns).sort('match_name').equals(full.sort('match_name'))
+
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '--append-to', table,
+                    '--output-format', 'parquet', '-o', table)
+    assert f'{len(gather_csvs)} file(s) already in' in runtmp.last_result.out
+    assert 'Nothing new to add.' in runtmp.last_result.out
+
+
+def test_hash_tables_incremental(runtmp):
+    ranktable, sketches, hashvals, sigs = make_hash_inputs(runtmp.location, n_samples=4)
+    first = runtmp.output('first.sig')
+    with open(first, 'wb') as fp:
+        save_signatures_to_json(sigs[:2], fp)
+
+    output = runtmp.output('presence.parquet')
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, first, '--scaled', '1000',
+                    '--format', 'parquet', '--incremental', '-o', output)
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, sketches, '--scaled', '1000',
+                    '--format', 'parquet', '--incremental', '-o', output)
+    assert 'Mapped 2 new or changed samples, 2 unchanged.' in runtmp.last_result.out
+
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, sketches, '--scaled', '1000',
+                    '--format', 'parquet', '-o', runtmp.output('full.parquet'))
+    assert pl.read_parquet(output).equals(pl.read_parquet(runtmp.output('full.parquet')))
+
+    with open(output + '.manifest.json') as fp:
+        manifest = json.load(fp)
+    assert manifest['samples'] == {ss.name: ss.md5sum() for ss in sigs}
+
+    # samples that left the inputs are dropped from the table and the manifest
+    rest = runtmp.output('rest.sig')
+    with open(rest, 'wb') as fp:
+        save_signatures_to_json(sigs[1:], fp)
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, rest, '--scaled', '1000',
+                    '--format', 'parquet', '--incremental', '-o', output)
+    assert 'Dropping 1 samples no longer in the inputs: sample0' in runtmp.last_result.out
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, rest, '--scaled', '1000',
+                    '--format', 'parquet', '-o', runtmp.output('rest.parquet'))
+    assert pl.read_parquet(output).equals(pl.read_parquet(runtmp.output('rest.parquet')))
+    with open(output + '.manifest.json') as fp:
+        assert sorted(json.load(fp)['samples']) == [ss.name for ss in sigs[1:]]
+
+
+def test_iter_sketch_rows_known_md5s(runtmp):
+    ranktable, sketches, hashvals, sigs = make_hash_inputs(runtmp.location)
+    zipfile = runtmp.output('sketches.zip')
+    with SaveSignaturesToLocation(zipfile) as save_sigs:
+        for ss in sigs:
+            save_sigs.add(ss)
+    hash_index = build_hashval_index(pl.Series('hashval', hashvals))
+    select_kw = dict(ksize=31, moltype='DNA', scaled=1000, abund=False)
+
+    # sample1 changed; the unchanged sketches are excluded by the zip manifest md5s
+    known_md5s = {ss.name: ss.md5sum() for ss in sigs}
+    known_md5s['sample1'] = 'stale'
+    stats = dict(selected=0, skipped=0, unchanged=0)
+    seen = set()
+    hits = list(iter_sketch_rows(zipfile, hash_index, select_kw, scaled=1000, known_md5s=known_md5s,
+                                 stats=stats, seen=seen))
+    assert [(name, md5sum) for name, md5sum, rows, values in hits] == [('sample1', sigs[1].md5sum())]
+    assert stats == dict(selected=4, skipped=0, unchanged=3)
+    assert seen == {ss.name for ss in sigs}
+
+
+def test_iter_sketch_rows(runtmp):
+    ranktable, sketches, hashvals, sigs = make_hash_inputs(runtmp.location)
+    hash_index = build_hashval_index(pl.Series('hashval', hashvals))
+    select_kw = dict(ksize=31, moltype='DNA', scaled=1000, abund=False)
+
+    stats = dict(selected=0, skipped=0, unchanged=0)
+    rows_iter = iter_sketch_rows(sketches, hash_index, select_kw, scaled=1000,
+                                 filter_by_name={'sample1', 'sample3'}, stats=stats)
+    assert isinstance(rows_iter, types.GeneratorType)
+
+    hits = {name: rows for name, md5sum, rows, values in rows_iter}
+    assert sorted(hits) == ['sample1', 'sample3']
+    assert stats == dict(selected=2, skipped=2, unchanged=0)
+    for ss in sigs[1::2]:
+        expected = sorted(i for i, h in enumerate(hashvals) if h in set(ss.minhash.hashes))
+        assert hits[ss.name].tolist() == expected
+
+
+def test_hash_tables_filter_samples_zip(runtmp):
+    ranktable, sketches, hashvals, sigs = make_hash_inputs(runtmp.location)
+    zipfile = runtmp.output('sketches.zip')
+    with SaveSignaturesToLocation(zipfile) as save_sigs:
+        for ss in sigs:
+            save_sigs.add(ss)
+
+    names = runtmp.output('names.txt')
+    with open(names, 'wt') as fp:
+        fp.write('sample0\nsample2\n')
+
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, zipfile, '--scaled', '1000',
+                    '--filter-samples', names, '-o', runtmp.output('zip.csv'))
+    assert 'Selected 2 samples by name; skipped 2 samples.' in runtmp.last_result.out
+
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, sketches, '--scaled', '1000',
+                    '-o', runtmp.output('all.csv'))
+    all_df = pl.read_csv(runtmp.output('all.csv'))
+    assert pl.read_csv(runtmp.output('zip.csv')).equals(all_df.select('hashval', 'sample0', 'sample2'))
+
+
+def test_hash_tables_abundance(runtmp):
+    ranktable, sketches, hashvals, sigs = make_hash_inputs(runtmp.location, track_abundance=True)
+    group = runtmp.output('group.txt')
+    with open(group, 'wt') as fp:
+        fp.write('groupA\nsample0\nsample2\n')
+
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, sketches, '--scaled', '1000',
+                    '--abundance', '-o', runtmp.output('abund.csv'))
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, sketches, '--scaled', '1000',
+                    '--abundance', 'normalized', '-o', runtmp.output('norm.csv'))
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, sketches, '--scaled', '1000',
+                    '--abundance', '--total-count', '-o', runtmp.output('total.csv'))
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, sketches, '--scaled', '1000',
+                    '--abundance', '--collapse-columns', group, '-o', runtmp.output('collapsed.csv'))
+
+    abund = pl.read_csv(runtmp.output('abund.csv'))
+    norm = pl.read_csv(runtmp.output('norm.csv'))
+    total = pl.read_csv(runtmp.output('total.csv'))
+    for ss in sigs:
+        hashes = ss.minhash.hashes
+        assert abund[ss.name].to_list() == [hashes.get(h, 0) for h in hashvals]
+        assert norm[ss.name].to_list() == pytest.approx([hashes.get(h, 0) / sum(hashes.values()) for h in hashvals])
+        assert total[ss.name].item() == abund[ss.name].sum()
+    assert total['count'].item() == sum(abund[ss.name].sum() for ss in sigs)
+
+    collapsed = pl.read_csv(runtmp.output('collapsed.csv'))
+    assert collapsed['groupA'].to_list() == (abund['sample0'] + abund['sample2']).to_list()
+
+
+def test_collapse_column_groups(runtmp):
+    paths = []
+    for name, members in [('g1', ['a', 'c']), ('g2', ['b', 'missing']), ('none', ['missing']), ('g1', ['b'])]:
+        paths.append(runtmp.output(f'{name}-{len(paths)}.txt'))
+        with open(paths[-1], 'wt') as fp:
+            fp.write('\n'.join([name] + members) + '\n')
+    groups = read_column_groups(paths)
+
+    matrix = np.array([[1, 0, 2], [0, 3, 4]], dtype=np.int32)
+    names, sums = collapse_column_groups(matrix, ['a', 'b', 'c'], groups)
+    # empty groups are skipped; a repeated group name replaces the earlier group in place
+    assert names == ['g1', 'g2']
+    assert sums.dtype == np.int32
+    assert sums.tolist() == [[0, 0], [3, 3]]
+
+    sparse_names, sparse_sums = collapse_column_groups(scipy.sparse.csr_array(matrix), ['a', 'b', 'c'], groups)
+    assert sparse_names == names and sparse_sums.tolist() == sums.tolist()
+
+
+def test_gather_tables_extract_columns(runtmp):
+    gather_csvs = sorted(glob.glob(utils.get_test_data('crc-human-saliva/*.csv')))
+    group1, group2 = runtmp.output('group1.txt'), runtmp.output('group2.txt')
+    with open(group1, 'wt') as fp:
+        fp.write('group1\nERR2764879\nnot-a-sample\n')
+    with open(group2, 'wt') as fp:
+        fp.write('group2\nERR2764877\nERR2764879\n')
+
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '-o', runtmp.output('full.csv'))
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs,
+                    '--extract-columns', group1, group2, '-o', runtmp.output('extract.csv'))
+
+    full = pl.read_csv(runtmp.output('full.csv'))
+    extract = pl.read_csv(runtmp.output('extract.csv'))
+    assert extract.columns == ['match_name', 'ERR2764879', 'ERR2764877']
+
+    # rows that are zero in every extracted sample are dropped
+    expected = full.select(extract.columns).filter(pl.any_horizontal(pl.col('ERR2764879', 'ERR2764877') != 0))
+    assert len(expected) < len(full)
+    assert extract.sort('match_name').equals(expected.sort('match_name'))
+
+
+def test_gather_tables_single_scan(runtmp):
+    gather_csvs = sorted(glob.glob(utils.get_test_data('crc-human-saliva/*.csv')))
+    parquet = runtmp.output('extra.gather.parquet')
+    pl.read_csv(gather_csvs[-1]).write_parquet(parquet)
+    empty = runtmp.output('empty.gather.csv')
+    open(empty, 'wt').close()
+
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '-o', runtmp.output('csv.csv'))
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs[:2], empty, *gather_csvs[2:-1], parquet,
+                    '--explain', '-o', runtmp.output('mixed.csv'))
+
+    # the csv inputs around the empty file share one scan; the parquet file gets its own
+    assert 'Csv SCAN' in runtmp.last_result.out
+    assert '3 other sources' in runtmp.last_result.out
+    assert 'PARQUET SCAN' in runtmp.last_result.out.upper()
+    assert pl.read_csv(runtmp.output('csv.csv')).equals(pl.read_csv(runtmp.output('mixed.csv')))
+
+
+def test_tables_bench(runtmp):
+    data_dir = runtmp.output('bench')
+    runtmp.sourmash('scripts', 'tables_bench', '--data-dir', data_dir, '--files', '3', '--matches', '20',
+                    '--genomes', '50', '--sketches', '3', '--hashes', '200', '-r', '1',
+                    '-b', 'gather_dense', 'prefetch', 'compare_rows')
+
+    with open(os.path.join(data_dir, 'results.json')) as fp:
+        report = json.load(fp)
+    assert report['scale']['files'] == 3
+    assert [result['benchmark'] for result in report['results']] == ['gather_dense', 'prefetch', 'compare_rows']
+    for result in report['results']:
+        assert result['returncode'] == 0
+        assert result['wall_seconds'] > 0 and result['max_rss_mb'] > 0
+    commands = {result['benchmark']: result['command'] for result in report['results']}
+    assert commands['prefetch'].startswith(f"sourmash scripts prefetch_tables {data_dir}/prefetch/*.prefetch.csv -o")
+    # the two compared tables come from the two sketch collections
+    assert 'compare_1.csv' in commands['compare_rows'] and 'compare_2.csv' in commands['compare_rows']
+    with open(os.path.join(data_dir, 'compare_rows.csv')) as fp:
+        assert len(fp.readlines()) == 4
+
+    # a baseline that is much faster than any real run counts as a regression
+    for result in report['results']:
+        result['wall_seconds'] = 1e-6
+    baseline = runtmp.output('baseline.json')
+    with open(baseline, 'wt') as fp:
+        json.dump(report, fp)
+    with pytest.raises(SourmashCommandFailed):
+        runtmp.sourmash('scripts', 'tables_bench', '--data-dir', data_dir, '--files', '3', '--matches', '20',
+                        '--genomes', '50', '--sketches', '3', '--hashes', '200', '-r', '1',
+                        '-b', 'gather_dense', '--baseline', baseline)
+
+
+def test_profile_json(runtmp):
+    gather_csvs = sorted(glob.glob(utils.get_test_data('crc-human-saliva/*.csv')))
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '-o', runtmp.output('gather.csv'),
+                    '--profile-json', runtmp.output('gather.json'), '--profile-plans')
+    ranktable, sketches, hashvals, sigs = make_hash_inputs(runtmp.location)
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, sketches, '--scaled', '1000',
+                    '-o', runtmp.output('hash.csv'), '--profile-json', runtmp.output('hash.json'))
+
+    with open(runtmp.output('gather.json')) as fp:
+        profile = json.load(fp)
+    assert profile['command'] == 'gather_tables' and profile['completed']
+    assert [stage['stage'] for stage in profile['stages']] == ['scan_inputs', 'collect', 'pivot', 'write']
+    pivot = profile['stages'][2]
+    assert pivot['columns_out'] == len(gather_csvs) + 1
+    assert pivot['seconds'] >= 0 and pivot['peak_rss_mb'] > 0
+    assert pivot['rss_start_mb'] > 0 and pivot['rss_end_mb'] > 0
+    if os.path.exists('/proc/self/clear_refs'):
+        # the high-water mark is reset per stage, so each stage reports its own peak
+        assert all(stage['peak_rss_scope'] == 'stage' for stage in profile['stages'])
+    assert profile['peak_rss_mb'] >= max(stage['peak_rss_mb'] for stage in profile['stages'])
+    assert 'SCAN' in profile['plans'][runtmp.output('gather.csv')]
+
+    with open(runtmp.output('hash.json')) as fp:
+        profile = json.load(fp)
+    stages = {stage['stage']: stage for stage in profile['stages']}
+    assert list(stages) == ['load_ranktable', 'map_sketches', 'build_frame', 'write']
+    assert stages['load_ranktable']['rows_out'] == len(hashvals)
+    assert stages['map_sketches']['samples_out'] == len(sigs)
+
+
+def test_gather_tables_report(runtmp):
+    gather_csvs = sorted(glob.glob(utils.get_test_data('crc-human-saliva/*.csv')))
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '-o', runtmp.output('full.csv'))
+    assert 'shape: (' in runtmp.last_result.out
+
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '--report', 'summary',
+                    '-o', runtmp.output('summary.csv'))
+    assert f"Wrote a 25 x {len(gather_csvs) + 1} table" in runtmp.last_result.out
+    assert 'non-zero values in' in runtmp.last_result.out
+    # no name contains a comma, so the plain `column` hint is enough
+    assert 'sed -E' not in runtmp.last_result.out
+
+    with open(runtmp.output('full.csv')) as fp1, open(runtmp.output('summary.csv')) as fp2:
+        assert fp1.read() == fp2.read()
+
+
+def test_table_stats():
+    df = pl.DataFrame({'match_name': ['a', 'b, strain 2', 'c', 'd'], 'ERR1': [0, 5, 2, 0], 'ERR2': [1, 1, 0, 7]})
+    stats = TableStats('match_name')
+    for start in (0, 2):
+        stats.update(df.slice(start, 2))
+
+    assert stats.names_with_commas
+    assert stats.to_frame().to_dicts() == [
+        dict(column='ERR1', nonzero=2, sum=7, min=0, max=5),
+        dict(column='ERR2', nonzero=3, sum=9, min=0, max=7),
+    ]
+    plain = TableStats('match_name')
+    plain.update(df.slice(2, 2))
+    assert not plain.names_with_commas
+
+
+def test_write_gzip_members(runtmp):
+    df = pl.DataFrame({'match_name': [f'genome {i}, strain' for i in range(1000)], 'ERR1': range(1000)})
+    output = runtmp.output('table.csv.gz')
+    write_gzip_members((df.slice(start, 64) for start in range(0, len(df), 64)), output, cores=4)
+
+    with open(output, 'rb') as fp:
+        data = fp.read()
+    # one gzip member per chunk, read back as a single stream
+    assert data.count(b'\x1f\x8b\x08') >= 16
+    assert gzip.decompress(data).decode() == df.write_csv()
+    assert pl.read_csv(output).equals(df)
+
+
+def test_gather_tables_categorical_names(runtmp):
+    gather_csvs = sorted(glob.glob(utils.get_test_data('crc-human-saliva/*.csv')))
+    lazy_frames, processed, skipped = scan_inputs(gather_csvs, 'intersect_bp', filter_rows=1000)
+    schema = pl.concat(lazy_frames).collect_schema()
+    assert schema['query_name'] == pl.Categorical and schema['match_name'] == pl.Categorical
+
+    # names are decoded to strings on output
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '--output-format', 'parquet',
+                    '-o', runtmp.output('dense.parquet'))
+    runtmp.sourmash('scripts', 'gather_tables', *gather_csvs, '-f', 'sparse', '--output-format', 'parquet',
+                    '-o', runtmp.output('sparse.parquet'))
+    assert pl.read_parquet_schema(runtmp.output('dense.parquet'))['match_name'] == pl.String
+    sparse_schema = pl.read_parquet_schema(runtmp.output('sparse.parquet'))
+    assert sparse_schema['match_name'] == pl.String and sparse_schema['query_name'] == pl.String
+
+
+def test_hash_tables_ranktable_index(runtmp):
+    ranktable, sketches, hashvals, sigs = make_hash_inputs(runtmp.location, n_hashes=200)
+    index = runtmp.output('ranktable.idx')
+    runtmp.sourmash('scripts', 'ranktable_index', ranktable, '-o', index, '--scaled', '2000')
+    assert os.path.exists(os.path.join(index, 'scaled-2000.npy'))
+
+    # the index is memory-mapped, not copied
+    index_hashvals, dtype, (sorted_hashvals, order), views = load_ranktable_index(index)
+    assert isinstance(index_hashvals, np.memmap) and isinstance(sorted_hashvals, np.memmap)
+    assert index_hashvals.tolist() == hashvals and list(views) == [2000]
+
+    runtmp.sourmash('scripts', 'hash_tables', ranktable, sketches, '--scaled', '1000', '-o', runtmp.output('csv.csv'))
+    runtmp.sourmash('scripts', 'hash_tables', index, sketches, '--scaled', '1000', '-o', runtmp.output('idx.csv'))
+    with open(runtmp.output('csv.csv'), 'rb') as fp1, open(runtmp.output('idx.csv'), 'rb') as fp2:
+        assert fp1.read() == fp2.read()
+
+    # downsampling keeps the ranktable rows below the new max_hash, with or without a precomputed view
+    for scaled in (2000, 3000):
+        runtmp.sourmash('scripts', 'hash_tables', ranktable, sketches, '--scaled', str(scaled),
+                        '-o', runtmp.output(f'csv-{scaled}.csv'))
+        runtmp.sourmash('scripts', 'hash_tables', index, sketches, '--scaled', str(scaled),
+                        '-o', runtmp.output(f'idx-{scaled}.csv'))
+        kept = [h for h in hashvals if h <= _get_max_hash_for_scaled(scaled)]
+        assert 0 < len(kept) < len(hashvals)
+        for name in ('csv', 'idx'):
+            df = pl.read_csv(runtmp.output(f'{name}-{scaled}.csv'))
+            assert df['hashval'].to_list() == kept
+            for ss in sigs:
+                hashes = set(ss.minhash.downsample(scaled=scaled).hashes)
+                assert df[ss.name].to_list() == [int(h in hashes) for h in kept]